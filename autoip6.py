@@ -1,15 +1,14 @@
-import requests
 import re
 import os
 import time
-import ipaddress
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.options import Options
+import itertools
+from geo_cache import default_cache
+from geo_resolver import resolve, prefetch_all, render_label
+from source_fetch import SourceState, fetch_sources
+from ip_extract import (IPExtractor, ipv4_set, ipv6_set, unpack_ipv4, unpack_ipv6, parse_ipv4, parse_ipv6,
+                        format_ipv4, format_ipv6)
+from source_backends import render
+from run_report import span, count, log, finish
 
 # 目标URL列表
 urls = [
@@ -25,12 +24,14 @@ urls = [
     #'https://api.uouin.com/cloudflare.html',
     #'https://ipdb.api.030101.xyz/?type=bestcf&country=true',
     #'https://addressesapi.090227.xyz/CloudFlareYes',
+    #'https://ip.164746.xyz',
 ]
 
-# 正则表达式用于初步匹配IPV4与IPV6地址(配合ipaddress库二次过滤)
-ipv4_pattern = r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b'
-# 新版IPv6 pattern: 支持压缩格式(如::), 大/小写
-ipv6_pattern = r'(?:(?:[0-9A-Fa-f]{1,4}:){6}(?:[0-9A-Fa-f]{1,4}|(?<=:)[0-9A-Fa-f]{0,4})|(?:[0-9A-Fa-f]{1,4}:){5}(?::[0-9A-Fa-f]{1,4}){1,2}|(?:[0-9A-Fa-f]{1,4}:){4}(?::[0-9A-Fa-f]{1,4}){1,3}|(?:[0-9A-Fa-f]{1,4}:){3}(?::[0-9A-Fa-f]{1,4}){1,4}|(?:[0-9A-Fa-f]{1,4}:){2}(?::[0-9A-Fa-f]{1,4}){1,5}|(?:[0-9A-Fa-f]{1,4}:){1}(?::[0-9A-Fa-f]{1,4}){1,6}|(?::(?::[0-9A-Fa-f]{1,4}){1,7}|:)|(?:[0-9A-Fa-f]{1,4}:)(?::[0-9A-Fa-f]{1,4}){0,6})'
+# 需要渲染的动态站点: url -> 后端 ('selenium' 无头浏览器，按需导入; 'jsdata' 只解析页面脚本引用的数据接口)
+# 未列出的源都走普通 HTTP 抓取，不需要安装浏览器相关依赖
+source_backends = {
+    'https://ip.164746.xyz': 'selenium',
+}
 
 # 检查ip.txt和ipv6.txt文件是否存在,如果存在则删除它
 if os.path.exists('ip.txt'):
@@ -38,131 +39,112 @@ if os.path.exists('ip.txt'):
 if os.path.exists('ipv6.txt'):
     os.remove('ipv6.txt')
 
-# 使用集合存储IP地址实现自动去重
-unique_ipv4 = set()
-unique_ipv6 = set()
+# 地址以整数存入紧凑的有序集合自动去重 (IPv4 每个 4 字节，见 ip_extract.AddressSet)，按数值排序
+unique_ipv4 = ipv4_set()
+unique_ipv6 = ipv6_set()
 
-def setup_selenium():
-    # 设置无头Chrome浏览器
-    chrome_options = 选项()
-    chrome_options.add_argument("--headless")  # 无头模式,适合Actions
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=chrome_options)
-    return driver
+
+def restore(stored, unpack, new_set, parse):
+    """source_state.json 里上次的提取结果 (AddressSet.pack 的 base64) -> AddressSet"""
+    if isinstance(stored, list):  # 旧格式: 逐个地址的字符串列表
+        return new_set(map(parse, stored))
+    return unpack(stored or '')
+
+
+class SourceExtractor(IPExtractor):
+    """边下载边提取 IP；wetest.vip 的页面另外记下最新的更新时间戳 (调试用)"""
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.latest_ts = ''
+
+    def feed(self, chunk):
+        if 'wetest.vip' in self.url:
+            self.latest_ts = max([self.latest_ts] + re.findall(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})', chunk))
+        super().feed(chunk)
+
+
+# 并发抓取所有普通源(带 ETag/Last-Modified 条件请求，未变化的源返回 304 直接复用上次结果)，
+# 响应按块流式解析，不在内存里保留整个页面
+source_state = SourceState()
+with span('phase.fetch'):
+    fetched = fetch_sources([url for url in urls if url not in source_backends], source_state, sink=SourceExtractor)
 
 for url in urls:
     try:
-        if url == 'https://ip.164746.xyz':  # 针对动态站点用Selenium
-            print(f'Using Selenium for dynamic site: {url}')
-            driver = setup_selenium()
-            driver.get(url)
-            # 等待动态加载(调整时间或加按钮点击)
-            time.sleep(10)  # 等待JS加载IP
-            html_content = driver.page_source
-            driver.quit()
-        else:  # 其他URL用requests(添加no-cache headers)
-            # 随机化URL避免缓存(可选,针对频繁更新站点)
-            if 'wetest.vip' in url:
-                url_with_cache_bust = f"{url}?t={int(time.time())}"
-            else:
-                url_with_cache_bust = url
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Cache-Control': 'no-cache',
-                'Pragma': 'no-cache',
-                'If-None-Match': ''  # 清ETag缓存
-            }
-            response = requests.get(url_with_cache_bust, headers=headers, timeout=7)
-            if response.status_code == 200:
-                html_content = response.text
-                # 调试: 打印响应头,检查缓存状态
-                print(f'{url} Cache-Control header: {response.headers.get("Cache-Control", "none")}')
-            else:
-                print(f'Request failed for {url}: status {response.status_code}')
+        if url in source_backends:  # 动态站点按配置的后端渲染
+            with span('source.render', url=url):
+                html_content = render(url, source_backends[url])
+            size = len(html_content)
+            with span('source.extract', url=url):
+                extracted = SourceExtractor(url)
+                extracted.feed(html_content)
+                extracted.close()
+            del html_content
+        else:
+            result = fetched[url]
+            if result.not_modified:
+                entry = source_state.get(url)
+                reused_v4 = restore(entry.get('ipv4'), unpack_ipv4, ipv4_set, parse_ipv4)
+                reused_v6 = restore(entry.get('ipv6'), unpack_ipv6, ipv6_set, parse_ipv6)
+                unique_ipv4.update(reused_v4)
+                unique_ipv6.update(reused_v6)
+                log(f'{url} not modified, reused {len(reused_v4)} IPv4, {len(reused_v6)} IPv6')
+                continue
+            if result.status != 200:
+                print(f'Request failed for {url}: status {result.status or result.error}')
                 continue
+            size, extracted = result.bytes, result.parsed
 
-        # 确保内容获取(对Selenium也检查)
-        if 'html_content' in locals() and len(html_content) > 100:  # 过滤空内容
-            # 使用正则表达式查找IP地址
-            ipv4_matches = re.findall(ipv4_pattern, html_content)
-            ipv6_matches = re.findall(ipv6_pattern, html_content)
-            
-            # 用ipaddress校验并去重
-            valid_ipv4 = []
-            for ip in ipv4_matches:
-                try:
-                    ipaddress.IPv4Address(ip)
-                    unique_ipv4.add(ip)
-                    valid_ipv4.append(ip)
-                except ValueError:
-                    continue
-            valid_ipv6 = []
-            for ip in ipv6_matches:
-                try:
-                    ipaddress.IPv6Address(ip)
-                    unique_ipv6.add(ip.lower())
-                    valid_ipv6.append(ip)
-                except ValueError:
-                    continue
-            print(f'From {url} extracted: {len(ipv4_matches)} IPv4 candidates, {len(ipv6_matches)} IPv6 candidates (valid: {len(valid_ipv4)} IPv4, {len(valid_ipv6)} IPv6)')
+        # 确保内容获取(对动态站点也检查)
+        if size > 100:  # 过滤空内容
+            # 单遍提取 IPv4/IPv6 (含 IP:端口、[v6]:端口)，解析时即完成校验
+            unique_ipv4.update(extracted.ipv4)
+            unique_ipv6.update(extracted.ipv6)
+            # 记下本源提取结果 (打包成 base64，不逐个转字符串)，下次 304 时直接复用
+            entry = source_state.get(url)
+            entry['ipv4'] = extracted.ipv4.pack()
+            entry['ipv6'] = extracted.ipv6.pack()
+            log(f'From {url} extracted: {extracted.candidates} candidates (valid: {len(extracted.ipv4)} IPv4, {len(extracted.ipv6)} IPv6)')
             # 针对wetest.vip, 提取更新时间戳调试
-            if 'wetest.vip' in url:
-                timestamp_pattern = r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})'
-                timestamps = re.findall(timestamp_pattern, html_content)
-                if timestamps:
-                    latest_ts = max(timestamps)
-                    print(f'{url} latest update time: {latest_ts} (current time: {time.strftime("%Y-%m-%d %H:%M:%S")})')
+            if extracted.latest_ts:
+                print(f'{url} latest update time: {extracted.latest_ts} (current time: {time.strftime("%Y-%m-%d %H:%M:%S")})')
         else:
+            source_state.get(url).pop('ipv4', None)  # 没有可复用的结果，下次不发条件请求
             print(f'{url} content empty or too short, skipping')
-    except Exception as e:  # 捕获Selenium/requests错误
+    except Exception as e:  # 捕获渲染/requests错误
         print(f'Failed to process {url}: {e}')
+        count(f'source.error.{type(e).__name__}')
         continue
 
+source_state.save()
+
 # 调试: 打印最终unique大小
 print(f'Total unique IPv4: {len(unique_ipv4)}, IPv6: {len(unique_ipv6)}')
 
-# 查询每个IP的country_code
-def get_country_code(ip):
-    try:
-        url = f'https://api.ipinfo.io/lite/{ip}?token=6f75ff6b8f013b'
-        resp = requests.get(url, timeout=5)
-        if resp.status_code == 200:
-            data = resp.json()
-            return data.get('country_code') or data.get('country') or 'ZZ'
-        else:
-            return 'ZZ'
-    except Exception as e:
-        print(f"Failed to query country_code for IP {ip}: {e}")
-        return 'ZZ'
-
-# IPv4处理(即使空也写空文件)
-sorted_ipv4 = sorted(unique_ipv4, key=lambda ip: [int(part) for part in ip.split('.')])
-results_v4 = []
-for ip in sorted_ipv4:
-    country_code = get_country_code(ip)
-    results_v4.append(f"{ip}:8443#{country_code}")
-    time.sleep(1)
-with open('ip.txt', 'w', encoding='utf-8') as file:
-    for line in results_v4:
-        file.write(line + '\n')
-print(f'Saved {len(results_v4)} unique IPv4 addresses with country_code to ip.txt.')
+# 集合已按数值升序；归属地预取和写文件都直接遍历集合，地址文本用完即弃，不整体转成字符串列表
+# 先用 ip-api.com 批量接口解析全部 IP (每 100 个一次请求)，失败的再走 ipinfo 等备用，结果写入缓存
+# 同一 /24 (v4)、/48 (v6) 只查一次；备用查询按 ipinfo 的速率并发进行 (见 geo_resolver)
+with span('phase.geo_prefetch'):
+    prefetch_all(itertools.chain(map(format_ipv4, unique_ipv4), map(format_ipv6, unique_ipv6)), concurrency=8)
+
+# 两个文件各一遍顺序写出 (即使空也写空文件)，带缓冲
+with open('ip.txt', 'w', encoding='utf-8', buffering=1 << 16) as file:
+    for ip in map(format_ipv4, unique_ipv4):
+        file.write(f"{ip}:8443#{render_label(resolve(ip), 'country_code')}\n")
+print(f'Saved {len(unique_ipv4)} unique IPv4 addresses with country_code to ip.txt.')
 print(f'ip.txt size: {os.path.getsize("ip.txt") if os.path.exists("ip.txt") else 0} bytes')  # 调试大小
 
-# IPv6处理(即使空也写空文件)
-sorted_ipv6 = sorted(unique_ipv6)
-results_v6 = []
-for ip in sorted_ipv6:
-    country_code = get_country_code(ip)
-    results_v6.append(f"[{ip}]:8443#{country_code}-IPV6")
-    time.sleep(1)
-with open('ipv6.txt', 'w', encoding='utf-8') as file:
-    for line in results_v6:
-        file.write(line + '\n')
-print(f'Saved {len(results_v6)} unique IPv6 addresses with country_code to ipv6.txt.')
+with open('ipv6.txt', 'w', encoding='utf-8', buffering=1 << 16) as file:
+    for ip in map(format_ipv6, unique_ipv6):
+        file.write(f"[{ip}]:8443#{render_label(resolve(ip), 'country_code')}-IPV6\n")
+print(f'Saved {len(unique_ipv6)} unique IPv6 addresses with country_code to ipv6.txt.')
 print(f'ipv6.txt size: {os.path.getsize("ipv6.txt") if os.path.exists("ipv6.txt") else 0} bytes')  # 调试大小
 
+print(default_cache().stats())
+finish('autoip6.py')  # 写 run_report.json 并打印各阶段汇总
+
 # 最终调试: 列出当前目录文件
 print(f'Current directory: {os.getcwd()}')
 print(f'Directory files: {os.listdir(".")}')
@@ -0,0 +1,91 @@
+"""IP 提取微基准：旧的 re.findall + ipaddress 校验 对比 ip_extract 单遍提取
+
+用法: python bench/bench_extract.py [重复次数]
+"""
+import os
+import re
+import sys
+import time
+import random
+import ipaddress
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ip_extract import IPExtractor, extract, format_ipv4, format_ipv6  # noqa: E402
+
+# autoip6.py 原来使用的两条正则
+ipv4_pattern = r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b'
+ipv6_pattern = r'(?:(?:[0-9A-Fa-f]{1,4}:){6}(?:[0-9A-Fa-f]{1,4}|(?<=:)[0-9A-Fa-f]{0,4})|(?:[0-9A-Fa-f]{1,4}:){5}(?::[0-9A-Fa-f]{1,4}){1,2}|(?:[0-9A-Fa-f]{1,4}:){4}(?::[0-9A-Fa-f]{1,4}){1,3}|(?:[0-9A-Fa-f]{1,4}:){3}(?::[0-9A-Fa-f]{1,4}){1,4}|(?:[0-9A-Fa-f]{1,4}:){2}(?::[0-9A-Fa-f]{1,4}){1,5}|(?:[0-9A-Fa-f]{1,4}:){1}(?::[0-9A-Fa-f]{1,4}){1,6}|(?::(?::[0-9A-Fa-f]{1,4}){1,7}|:)|(?:[0-9A-Fa-f]{1,4}:)(?::[0-9A-Fa-f]{1,4}){0,6})'
+
+
+def legacy(text):
+    v4, v6 = set(), set()
+    for ip in re.findall(ipv4_pattern, text):
+        try:
+            ipaddress.IPv4Address(ip)
+            v4.add(ip)
+        except ValueError:
+            continue
+    for ip in re.findall(ipv6_pattern, text):
+        try:
+            ipaddress.IPv6Address(ip)
+            v6.add(ip.lower())
+        except ValueError:
+            continue
+    return v4, v6
+
+
+def make_page(rows, seed=1):
+    """模拟 wetest.vip 这类表格页面：大量十六进制样式/脚本 + IPv4/IPv6 行，另夹 '标签:IP' 形式的纯文本行"""
+    rng = random.Random(seed)
+    parts = ['<html><head><style>']
+    for _ in range(rows):
+        parts.append(f'.c{rng.getrandbits(32):08x}::before{{color:#{rng.getrandbits(24):06x}}}')
+    parts.append('</style><script>var h="')
+    parts.append(''.join(f'{rng.getrandbits(64):016x}:' for _ in range(rows)))
+    parts.append('";</script><table>')
+    for _ in range(rows):
+        v4 = ipaddress.IPv4Address(rng.getrandbits(32))
+        v6 = ipaddress.IPv6Address((0x2606_4700 << 96) | rng.getrandbits(96))
+        parts.append(f'<tr><td>{v4}:8443</td><td>[{v6}]:2053</td><td>2025-11-13 15:44:49</td></tr>')
+        # 纯文本列表里常见的 '标签:IP' 写法
+        label = rng.choice(('IP', 'addr', 'IPv4', 'x'))
+        parts.append(f'{label}:{ipaddress.IPv4Address(rng.getrandbits(32))}#US\n')
+    parts.append('</table></html>')
+    return ''.join(parts)
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for rows in (1000, 10000):
+        page = make_page(rows)
+        t_old, (v4_old, v6_old) = timed(lambda: legacy(page), repeat)
+        t_new, ex = timed(lambda: extract(page), repeat)
+
+        def streamed():
+            extractor = IPExtractor()
+            for i in range(0, len(page), 65536):
+                extractor.feed(page[i:i + 65536])
+            return extractor.close()
+        t_stream, ex_stream = timed(streamed, repeat)
+
+        v4_new = {format_ipv4(v) for v in ex.ipv4}
+        v6_new = {format_ipv6(v) for v in ex.ipv6}
+        v6_old_norm = {ipaddress.IPv6Address(ip).compressed for ip in v6_old}
+        print(f'{rows} 行, {len(page) / 1048576:.1f}MB:')
+        print(f'  旧正则   {t_old * 1000:8.1f}ms  IPv4 {len(v4_old)}, IPv6 {len(v6_old)}')
+        print(f'  单遍提取 {t_new * 1000:8.1f}ms  IPv4 {len(v4_new)}, IPv6 {len(v6_new)}  ({t_old / t_new:.1f}x)')
+        print(f'  分块提取 {t_stream * 1000:8.1f}ms  结果一致: {ex_stream.ipv4 == ex.ipv4 and ex_stream.ipv6 == ex.ipv6}')
+        print(f'  IPv4 一致: {v4_new == v4_old}, IPv6 仅旧正则有: {len(v6_old_norm - v6_new)}, 仅新提取有: {len(v6_new - v6_old_norm)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""端到端基准：在本地替身服务上跑 test_speed.py / 国家查询test_speed.py / autoip6.py
+
+每个流程在独立的临时目录里作为子进程运行 (HTTP(S)_PROXY 指向 mock_services 的代理，
+候选 IP 都在 127.0.0.0/8)，统计墙钟时间、各服务收到的请求数 (含 429)、测速连接数和字节数、
+子进程峰值 RSS。--warm 时同一目录再跑一次，对比冷/热缓存 (geo_cache.db、source_state.json、results.db)。
+需要 Linux (127.x.y.z 免配置可绑定) 和 openssl 命令行。
+
+用法: python bench/bench_pipeline.py [--flows speed,sharded,country,autoip6] [--ips 40] [--warm] [--json report.json]
+其余调参直接用环境变量传给被测脚本，如 SPEED_CONCURRENCY=8 python bench/bench_pipeline.py
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_services import MockServices, make_profiles  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLOWS = {
+    'speed': ['test_speed.py'],
+    'sharded': ['test_speed.py', '--jobs', '4'],  # 本机 4 个进程分片测速再合并 (speed_shard)
+    'country': ['国家查询test_speed.py'],
+    'autoip6': ['autoip6.py'],
+}
+
+
+def run_flow(name, workdir, services):
+    """在 workdir 里跑一个流程，返回该次运行的统计"""
+    env = dict(os.environ)
+    for key in ('NO_PROXY', 'no_proxy'):
+        env.pop(key, None)
+    env.update({
+        'HTTP_PROXY': services.proxy, 'HTTPS_PROXY': services.proxy,
+        'http_proxy': services.proxy, 'https_proxy': services.proxy,
+        'REQUESTS_CA_BUNDLE': services.cert,
+        'SPEED_INPUT': env.get('SPEED_INPUT', 'ip.txt'),
+        'PYTHONUNBUFFERED': '1',
+    })
+    before = services.counters.snapshot()
+    log_path = os.path.join(workdir, f'{name}.log')
+    with open(log_path, 'a', encoding='utf-8') as log:
+        start = time.monotonic()
+        proc = subprocess.Popen([sys.executable, os.path.join(REPO, FLOWS[name][0])] + FLOWS[name][1:],
+                                cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.monotonic() - start
+    delta = services.counters.snapshot()
+    delta.subtract(before)
+    requests = {key: n for key, n in sorted(delta.items()) if n and not key.startswith('speed/')}
+    return {
+        'flow': name,
+        'exit': proc.returncode,
+        'wall_s': round(wall, 2),
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),  # Linux 下 ru_maxrss 单位为 KB
+        'requests': requests,
+        'requests_total': sum(requests.values()),
+        'rate_limited': sum(n for key, n in requests.items() if key.endswith('/429')),
+        'speed_connections': delta['speed/connections'],
+        'speed_mb': round(delta['speed/bytes'] / 1048576, 1),
+        'log': log_path,
+    }
+
+
+def print_report(rows):
+    print(f"\n{'流程':<10}{'轮次':<6}{'退出码':>6}{'墙钟(s)':>10}{'峰值RSS(MB)':>13}{'请求':>7}{'429':>6}{'测速连接':>9}{'测速MB':>9}")
+    for row in rows:
+        print(f"{row['flow']:<10}{row['round']:<6}{row['exit']:>6}{row['wall_s']:>10}{row['peak_rss_mb']:>13}"
+              f"{row['requests_total']:>7}{row['rate_limited']:>6}{row['speed_connections']:>9}{row['speed_mb']:>9}")
+    for row in rows:
+        print(f"  {row['flow']}/{row['round']}: {row['requests']}  日志 {row['log']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地替身服务上的端到端基准')
+    parser.add_argument('--flows', default='speed,country,autoip6', help=f'逗号分隔，可选 {",".join(FLOWS)}')
+    parser.add_argument('--ips', type=int, default=40, help='测速候选 IP 数')
+    parser.add_argument('--per24', type=int, default=2, help='每个 /24 放几个候选 IP')
+    parser.add_argument('--failure-rate', type=float, default=0.1, help='出故障的候选比例')
+    parser.add_argument('--max-mbps', type=float, default=80)
+    parser.add_argument('--source-ips', type=int, default=200, help='每个源列表返回的 IPv4 行数 (另加 1/10 的 IPv6)')
+    parser.add_argument('--ip-api-rate', type=int, default=45, help='ip-api.com 单查每分钟上限')
+    parser.add_argument('--ip-api-batch-rate', type=int, default=15, help='ip-api.com 批量每分钟上限')
+    parser.add_argument('--ipinfo-rate', type=int, default=0, help='ipinfo 每分钟上限，0 不限')
+    parser.add_argument('--warm', action='store_true', help='同一目录再跑一次，测热缓存')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='把结果写成 JSON，便于前后对比')
+    args = parser.parse_args(argv)
+
+    profiles = make_profiles(args.ips, args.per24, args.failure_rate, max_mbps=args.max_mbps, seed=args.seed)
+    root = tempfile.mkdtemp(prefix='bench-pipeline-')
+    services = MockServices(profiles, source_ips=args.source_ips, ip_api_rate=args.ip_api_rate,
+                            ip_api_batch_rate=args.ip_api_batch_rate, ipinfo_rate=args.ipinfo_rate,
+                            workdir=root, seed=args.seed).start()
+    failures = sum(1 for p in profiles.values() if p.failure)
+    print(f'替身服务: 代理 {services.proxy}, 测速端口 {services.port}, 候选 {len(profiles)} 个 (故障 {failures} 个), 目录 {root}')
+
+    rows = []
+    try:
+        for name in [f for f in args.flows.split(',') if f]:
+            workdir = os.path.join(root, name)
+            os.makedirs(workdir)
+            with open(os.path.join(workdir, 'ip.txt'), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(services.candidates()) + '\n')
+            for round_name in (['cold', 'warm'] if args.warm else ['cold']):
+                print(f'运行 {name} ({round_name})...')
+                row = run_flow(name, workdir, services)
+                row['round'] = round_name
+                rows.append(row)
+    finally:
+        services.close()
+
+    print_report(rows)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+    return 1 if any(row['exit'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
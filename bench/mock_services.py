@@ -0,0 +1,397 @@
+"""本地替身服务：模拟 speed.cloudflare.com 测速端点、归属地 API 和 IP 源列表，只监听回环地址
+
+- 测速: 每个候选 IP (127.x.y.z) 单独监听，TLS 上响应 `GET /__down?bytes=N`，
+  按 IP 的配置限速、加延迟或制造故障 (refuse 拒绝连接 / reset 握手前断开 / stall 不响应 /
+  http 返回 403 / truncate 只发一半)。127.0.0.0/8 整段都是回环地址 (Linux)，不需要额外配置网卡。
+- 归属地与源列表: 一个 HTTP 代理，被测脚本设置 HTTP(S)_PROXY 指向它。http 请求直接应答，
+  https 的 CONNECT 隧道用自签证书解开 (REQUESTS_CA_BUNDLE 指向该证书)，按 Host 分发到
+  ip-api.com (单查 + 批量)、ipgeolocation.io、ipinfo.io、api.ipinfo.io 和源列表的模拟实现；
+  各服务按固定窗口限流，超出时返回 429 和对应的限流头。
+
+所有请求按 "服务/类别" 计数，供 bench_pipeline.py 统计每次运行发出的请求数。
+单独运行: python bench/mock_services.py [--ips 40]  (打印代理地址和候选列表后一直运行)
+"""
+import os
+import ssl
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple, Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+MOCK_HOSTS = ('ip-api.com', 'api.ipgeolocation.io', 'ipinfo.io', 'api.ipinfo.io',
+              'raw.githubusercontent.com', 'speed.cloudflare.com')
+CHUNK = 64 * 1024
+
+# (国家代码, 英文国家名, 英文城市, 中文城市)，按 IP 的哈希固定分配
+LOCATIONS = [
+    ('US', 'United States', 'San Francisco', '旧金山'),
+    ('US', 'United States', 'Los Angeles', '洛杉矶'),
+    ('US', 'United States', 'Seattle', '西雅图'),
+    ('JP', 'Japan', 'Tokyo', '东京'),
+    ('SG', 'Singapore', 'Singapore', '新加坡'),
+    ('HK', 'Hong Kong', 'Hong Kong', '香港'),
+    ('DE', 'Germany', 'Frankfurt', '法兰克福'),
+    ('NL', 'Netherlands', 'Amsterdam', '阿姆斯特丹'),
+]
+
+# 单个候选 IP 的测速表现；mbps 为 MB/s，latency 为握手前和首字节前各加的延迟 (毫秒)，
+# colo 为 /cdn-cgi/trace 返回的数据中心
+SpeedProfile = namedtuple('SpeedProfile', 'mbps latency failure colo')
+COLOS = ('LAX', 'SJC', 'SEA', 'HKG', 'NRT', 'SIN', 'FRA')
+FAILURES = ('refuse', 'reset', 'stall', 'http', 'truncate')
+
+
+COUNTRY_ZH = {'US': '美国', 'JP': '日本', 'SG': '新加坡', 'HK': '中国香港', 'DE': '德国', 'NL': '荷兰'}
+
+
+def location_of(ip):
+    return LOCATIONS[zlib.crc32(ip.encode()) % len(LOCATIONS)]
+
+
+def make_profiles(count, per24=2, failure_rate=0.1, min_mbps=5, max_mbps=80, max_latency=150, seed=1):
+    """生成 count 个回环候选 IP 及其测速表现；每 per24 个 IP 共用一个 /24 (影响归属地前缀缓存命中)
+
+    同一 /24 落在同一个 colo，同一 colo 的带宽围绕该 colo 的基准速率浮动 (与真实路由相似，便于测 colo 分组)
+    """
+    rng = random.Random(seed)
+    bases = {colo: rng.uniform(min_mbps, max_mbps) for colo in COLOS}
+    profiles = {}
+    for i in range(count):
+        ip = f'127.{1 + i // per24 // 250}.{i // per24 % 250 + 1}.{i % per24 + 1}'
+        colo = COLOS[zlib.crc32(ip.rsplit('.', 1)[0].encode()) % len(COLOS)]
+        failure = rng.choice(FAILURES) if rng.random() < failure_rate else ''
+        mbps = min(max(bases[colo] * rng.uniform(0.7, 1.1), min_mbps), max_mbps)
+        profiles[ip] = SpeedProfile(round(mbps, 1), rng.uniform(0, max_latency), failure, colo)
+    return profiles
+
+
+def make_certificate(directory):
+    """用 openssl 生成覆盖全部模拟域名的自签证书，返回 (证书路径, 私钥路径)"""
+    cert, key = os.path.join(directory, 'mock.pem'), os.path.join(directory, 'mock.key')
+    san = ','.join(f'DNS:{host}' for host in MOCK_HOSTS)
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                    '-keyout', key, '-out', cert, '-subj', '/CN=bench-mock',
+                    '-addext', f'subjectAltName={san}', '-addext', 'basicConstraints=critical,CA:TRUE'],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+class Counters:
+    """线程安全的请求计数"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.counts)
+
+
+class RateWindow:
+    """固定窗口限流：period 秒内最多 limit 次，limit 为 0 表示不限"""
+
+    def __init__(self, limit, period=60.0):
+        self.limit = limit
+        self.period = period
+        self.window_start = time.monotonic()
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """返回 (是否允许, 窗口剩余次数, 窗口重置剩余秒数)"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.period:
+                self.window_start, self.used = now, 0
+            ttl = max(int(self.period - (now - self.window_start)), 1)
+            if self.limit and self.used >= self.limit:
+                return False, 0, ttl
+            self.used += 1
+            return True, (self.limit - self.used if self.limit else 999), ttl
+
+
+class SpeedServer:
+    """每个候选 IP 一个监听 socket，按 SpeedProfile 提供 /__down 和 /cdn-cgi/trace"""
+
+    def __init__(self, profiles, port, cert, key, counters):
+        self.profiles = profiles
+        self.port = port
+        self.counters = counters
+        self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ctx.load_cert_chain(cert, key)
+        self.sockets = []
+        self.closed = threading.Event()
+
+    def start(self):
+        for ip, profile in self.profiles.items():
+            if profile.failure == 'refuse':
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, self.port))
+            sock.listen(64)
+            self.sockets.append(sock)
+            threading.Thread(target=self._accept, args=(sock, profile), daemon=True).start()
+
+    def close(self):
+        self.closed.set()
+        for sock in self.sockets:
+            sock.close()
+
+    def _accept(self, sock, profile):
+        while not self.closed.is_set():
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn, profile), daemon=True).start()
+
+    def _serve(self, conn, profile):
+        self.counters.add('speed/connections')
+        sent = 0
+        try:
+            conn.settimeout(60)
+            if profile.failure == 'reset':
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, b'\x01\x00\x00\x00\x00\x00\x00\x00')
+                return
+            time.sleep(profile.latency / 1000)
+            conn = self.ctx.wrap_socket(conn, server_side=True)
+            request = b''
+            while b'\r\n\r\n' not in request:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                request += data
+            self.counters.add('speed/requests')
+            target = request.split(b' ', 2)[1].decode()
+            if profile.failure == 'stall':
+                while not self.closed.is_set() and conn.recv(4096):
+                    pass
+                return
+            if target == '/cdn-cgi/trace' and profile.failure != 'http':
+                self.counters.add('speed/trace')
+                body = (f'fl=1f1\nh=speed.cloudflare.com\nip=127.0.0.1\nts={time.time():.3f}\nvisit_scheme=https\n'
+                        f'uag=curl/8.0\ncolo={profile.colo}\nhttp=http/1.1\nloc=CN\ntls=TLSv1.3\n').encode()
+                conn.sendall(f'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n'
+                             f'Connection: close\r\n\r\n'.encode() + body)
+                return
+            if profile.failure == 'http' or not target.startswith('/__down'):
+                conn.sendall(b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+            size = int(parse_qs(urlsplit(target).query).get('bytes', ['0'])[0])
+            time.sleep(profile.latency / 1000)
+            conn.sendall(f'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n'
+                         f'Content-Length: {size}\r\nConnection: close\r\n\r\n'.encode())
+            limit = size // 2 if profile.failure == 'truncate' else size
+            rate = profile.mbps * 1048576
+            chunk = bytes(CHUNK)
+            start = time.monotonic()
+            while sent < limit:
+                n = min(CHUNK, limit - sent)
+                conn.sendall(chunk[:n])
+                sent += n
+                ahead = sent / rate - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except (OSError, ValueError, IndexError):
+            pass  # 客户端提前停止、探测只握手就断开等都属正常
+        finally:
+            self.counters.add('speed/bytes', sent)
+            conn.close()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """代理入口：http 请求按绝对 URL 分发，https 经 CONNECT 解开隧道后按 Host 分发"""
+
+    protocol_version = 'HTTP/1.1'
+    tunnel_host = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_CONNECT(self):
+        self.tunnel_host = self.path.split(':')[0]
+        self.send_response(200, 'Connection Established')
+        self.end_headers()
+        self.connection = self.server.tls.wrap_socket(self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb')
+        self.wfile = self.connection.makefile('wb', buffering=0)
+        self.close_connection = False
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        url = urlsplit(self.path)
+        host = self.tunnel_host or url.hostname or ''
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        route = self.server.routes.get(host, self.server.source_list)
+        status, headers, payload = route(self, url.path, parse_qs(url.query), body)
+        self.server.counters.add(f'{host}/{status}')
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json; charset=utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+
+class MockServices:
+    """启动全部替身服务；proxy 为被测脚本的 HTTP(S)_PROXY，cert 为需要信任的证书"""
+
+    def __init__(self, profiles, port=0, source_ips=200, ip_api_rate=45, ip_api_batch_rate=15, ipinfo_rate=0,
+                 workdir=None, seed=1):
+        self.profiles = profiles
+        self.workdir = workdir or tempfile.mkdtemp(prefix='mock-')
+        self.cert, self.key = make_certificate(self.workdir)
+        self.counters = Counters()
+        self.port = port or _free_port()
+        self.speed = SpeedServer(profiles, self.port, self.cert, self.key, self.counters)
+        self.limits = {
+            'ip-api/json': RateWindow(ip_api_rate),
+            'ip-api/batch': RateWindow(ip_api_batch_rate),
+            'ipinfo': RateWindow(ipinfo_rate),
+        }
+        self.source_ips = source_ips
+        self.seed = seed
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        self.http.daemon_threads = True
+        self.http.counters = self.counters
+        self.http.tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.http.tls.load_cert_chain(self.cert, self.key)
+        self.http.routes = {
+            'ip-api.com': self._ip_api,
+            'api.ipgeolocation.io': self._ipgeolocation,
+            'ipinfo.io': self._ipinfo,
+            'api.ipinfo.io': self._ipinfo_lite,
+        }
+        self.http.source_list = self._source_list
+        self.proxy = f'http://127.0.0.1:{self.http.server_address[1]}'
+
+    def start(self):
+        self.speed.start()
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        self.speed.close()
+        self.http.shutdown()
+        self.http.server_close()
+
+    def candidates(self):
+        """ip.txt 格式的候选行"""
+        return [f'{ip}:{self.port}#{location_of(ip)[0]}' for ip in self.profiles]
+
+    def _limited(self, name, ip_api_headers=False):
+        ok, remaining, ttl = self.limits[name].take()
+        headers = {'X-Rl': str(remaining), 'X-Ttl': str(ttl)} if ip_api_headers else {}
+        if not ok and not ip_api_headers:
+            headers['Retry-After'] = str(ttl)
+        return ok, headers
+
+    def _ip_api(self, handler, path, query, body):
+        if path == '/batch':
+            ok, headers = self._limited('ip-api/batch', True)
+            if not ok:
+                return 429, headers, b''
+            entries = json.loads(body or b'[]')
+            lang = query.get('lang', [''])[0]
+            return 200, headers, [self._ip_api_entry(e['query'] if isinstance(e, dict) else e, lang) for e in entries]
+        ok, headers = self._limited('ip-api/json', True)
+        if not ok:
+            return 429, headers, b''
+        return 200, headers, self._ip_api_entry(path.rsplit('/', 1)[-1], query.get('lang', [''])[0])
+
+    @staticmethod
+    def _ip_api_entry(ip, lang=''):
+        code, country, city_en, city_zh = location_of(ip)
+        return {'status': 'success', 'query': ip, 'country': COUNTRY_ZH.get(code, country) if lang == 'zh-CN' else country,
+                'countryCode': code,
+                'city': city_zh if lang == 'zh-CN' else city_en, 'as': 'AS13335 Cloudflare, Inc.'}
+
+    def _ipgeolocation(self, handler, path, query, body):
+        ip = query.get('ip', [''])[0]
+        code, country, city_en, _ = location_of(ip)
+        return 200, {}, {'ip': ip, 'country_code2': code, 'country_name': country, 'city': city_en}
+
+    def _ipinfo(self, handler, path, query, body):
+        ok, headers = self._limited('ipinfo')
+        if not ok:
+            return 429, headers, b''
+        ip = path.strip('/').split('/')[0]
+        code, _, city_en, _ = location_of(ip)
+        return 200, headers, {'ip': ip, 'city': city_en, 'country': code, 'org': 'AS13335 Cloudflare, Inc.'}
+
+    def _ipinfo_lite(self, handler, path, query, body):
+        ok, headers = self._limited('ipinfo')
+        if not ok:
+            return 429, headers, b''
+        ip = path.rstrip('/').rsplit('/', 1)[-1]
+        code, country, _, _ = location_of(ip)
+        return 200, headers, {'ip': ip, 'country_code': code, 'country': country, 'asn': 'AS13335'}
+
+    def _source_list(self, handler, path, query, body):
+        """任意其他 URL 都当作 IP 源列表：按路径固定生成 IPv4/IPv6 行，支持 ETag 条件请求"""
+        rng = random.Random(f'{self.seed}{path}')
+        lines = []
+        for _ in range(self.source_ips):
+            lines.append(f'104.{rng.randrange(16, 32)}.{rng.randrange(256)}.{rng.randrange(1, 255)}:443#CF')
+        for _ in range(self.source_ips // 10):
+            lines.append(f'[2606:4700:{rng.getrandbits(16):x}::{rng.getrandbits(16):x}]:443')
+        payload = '\n'.join(lines).encode()
+        etag = f'"{zlib.crc32(payload):08x}"'
+        if handler.headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag, 'Content-Type': 'text/plain; charset=utf-8'}, payload
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地替身服务 (测速/归属地/源列表)')
+    parser.add_argument('--ips', type=int, default=40, help='候选 IP 数')
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    services = MockServices(make_profiles(args.ips, failure_rate=args.failure_rate, seed=args.seed)).start()
+    print(f'HTTP(S)_PROXY={services.proxy}')
+    print(f'REQUESTS_CA_BUNDLE={services.cert}')
+    for line in services.candidates():
+        print(line)
+    try:
+        while True:
+            time.sleep(60)
+            print(dict(services.counters.snapshot()))
+    except KeyboardInterrupt:
+        services.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
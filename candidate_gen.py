@@ -0,0 +1,155 @@
+"""从 busi.txt 网段生成候选 IP，并根据历史测速结果偏向曾经测得快的 /24
+
+每个 /24 是一个老虎机臂 (bandit arm)，奖励为该网段 IP 在 results.db 里的实测 MB/s (失败记 0)；
+没有真正测过的 IP (预筛截掉、colo 分组跳过、预算用尽、增量模式沿用旧结果) 不计入。
+生成时对每个臂做一次 Thompson 采样 (均值 + 不确定度 × 正态随机数)，
+取得分最高的若干 /24，每个 /24 随机取 density 个主机地址；没测过的 /24 不确定度最大，
+所以仍会被持续探索。
+
+用法 (speed-test.yml 里按此顺序执行):
+  python candidate_gen.py update            # 用 results.db 里上次更新以来的测量更新历史
+  python candidate_gen.py generate          # 生成 candidates.txt (格式同 ip.txt)
+  SPEED_INPUT=ip.txt,candidates.txt python test_speed.py
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import ipaddress
+
+from geo_index import parse_source
+from results_store import ResultsStore, RESULTS_DB_PATH
+
+RANGES_PATH = 'busi.txt'
+HISTORY_PATH = os.environ.get('CANDIDATE_HISTORY_PATH', 'candidate_history.json')
+OUTPUT_PATH = 'candidates.txt'
+DEFAULT_PORT = 8443
+BUDGET = 50  # 每轮生成的候选数
+DENSITY = 2  # 每个选中的 /24 取几个主机地址
+MAX_WEIGHT = 20  # 每个臂最多按这么多次观测计权，之后相当于指数遗忘，适应网络变化
+PRIOR_SIGMA = 20.0  # 没有历史时的奖励标准差 (MB/s)
+V6_ARMS_PER_RANGE = 64
+FIRST_UPDATE_WINDOW = 86400  # 历史里没有上次更新时间时，只取最近这么久的测量 (秒)
+
+
+def load_history(path=HISTORY_PATH):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'arms': {}, 'pending': []}
+
+
+def save_history(history, path=HISTORY_PATH):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(history, f)
+    os.replace(tmp, path)
+
+
+def arm_of(ip):
+    """IP 所在 /24 (IPv6 为 /48)，作为臂的名字"""
+    addr = ipaddress.ip_address(ip)
+    bits = 24 if addr.version == 4 else 48
+    return str(ipaddress.ip_network(f'{addr}/{bits}', strict=False))
+
+
+def observe(history, ip, reward):
+    """记录一次观测，按增量均值更新臂 [次数, 平均奖励]"""
+    arms = history['arms']
+    n, mean = arms.get(arm_of(ip), [0, 0.0])
+    n = min(n + 1, MAX_WEIGHT)
+    mean += (reward - mean) / n
+    arms[arm_of(ip)] = [n, round(mean, 3)]
+
+
+def update(history, measurements):
+    """用上次更新以来的实测结果更新历史 (ResultsStore.measurements 的返回值)
+
+    每次测量都是一次观测：成功记其速率，失败记 0；其他来源的 IP 也能说明所在 /24 的质量。
+    上一轮生成的候选里没被测到的不算观测。返回 (测到的上轮候选数, 观测数)
+    """
+    pending = set(history.get('pending', []))
+    measured = set()
+    for ts, ip, mbps, success in measurements:
+        observe(history, ip, mbps if success else 0.0)
+        measured.add(ip)
+        history['last_update'] = max(history.get('last_update', 0), ts)
+    history['pending'] = []
+    return len(pending & measured), len(measurements)
+
+
+def _arms_in_ranges(ranges, family, rng):
+    """枚举网段内的全部 /24，返回 (网络基址, 主机位数)；IPv6 的 /48 太多，每个网段随机抽 V6_ARMS_PER_RANGE 个"""
+    for start, end, _ in ranges:
+        if family == 4:
+            for base in range(start & ~0xFF, end + 1, 256):
+                yield base, 8
+        else:
+            span = (end - start + 1) >> 80  # 网段内 /48 的个数
+            for _ in range(min(V6_ARMS_PER_RANGE, span)):
+                yield start + (rng.randrange(span) << 80), 80
+
+
+def generate(history, ranges, budget=BUDGET, density=DENSITY, family=4, rng=random):
+    """Thompson 采样选出 budget // density 个 /24，每个随机取 density 个主机，返回 IP 列表"""
+    arms = history['arms']
+    observed = [mean for _, mean in arms.values()]
+    prior_mean = sum(observed) / len(observed) if observed else 0.0
+    sigma = PRIOR_SIGMA
+    if len(observed) > 1:
+        sigma = max(math.sqrt(sum((m - prior_mean) ** 2 for m in observed) / (len(observed) - 1)), 1.0)
+
+    scored = []
+    for base, host_bits in _arms_in_ranges(ranges, family, rng):
+        name = arm_of(str(ipaddress.ip_address(base)))
+        n, mean = arms.get(name, [0, prior_mean])
+        score = mean + sigma / math.sqrt(n + 1) * rng.gauss(0, 1)
+        scored.append((score, base, host_bits))
+    scored.sort(reverse=True)
+
+    candidates = []
+    for _, base, host_bits in scored[:max(budget // density, 1)]:
+        for _ in range(density):
+            host = rng.randrange(1, (1 << host_bits) - 1)  # 避开 .0 / .255
+            candidates.append(str(ipaddress.ip_address(base | host)))
+    return candidates[:budget]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='按历史测速结果从 busi.txt 网段生成候选 IP')
+    parser.add_argument('command', choices=['update', 'generate'])
+    parser.add_argument('--ranges', default=RANGES_PATH)
+    parser.add_argument('--db', default=RESULTS_DB_PATH, help='update 读取的测量历史库')
+    parser.add_argument('--history', default=HISTORY_PATH)
+    parser.add_argument('-o', '--output', default=OUTPUT_PATH)
+    parser.add_argument('--budget', type=int, default=BUDGET, help='生成的候选数')
+    parser.add_argument('--density', type=int, default=DENSITY, help='每个 /24 取几个主机')
+    parser.add_argument('--family', type=int, choices=[4, 6], default=4)
+    args = parser.parse_args(argv)
+
+    history = load_history(args.history)
+    if args.command == 'update':
+        store = ResultsStore(args.db)
+        since = history.get('last_update') or time.time() - FIRST_UPDATE_WINDOW
+        n_pending, n_results = update(history, store.measurements(since))
+        store.close()
+        save_history(history, args.history)
+        print(f'历史已更新: 新测量 {n_results} 次 (其中上轮候选 {n_pending} 个), 已知 /24 {len(history["arms"])} 个')
+        return
+
+    with open(args.ranges, 'r', encoding='utf-8') as f:
+        v4, v6 = parse_source(f)
+    candidates = generate(history, v4 if args.family == 4 else v6, args.budget, args.density, args.family)
+    history['pending'] = candidates
+    save_history(history, args.history)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for ip in candidates:
+            f.write(f'{ip}:{DEFAULT_PORT}#CF\n' if args.family == 4 else f'[{ip}]:{DEFAULT_PORT}#CF-IPV6\n')
+    print(f'生成 {len(candidates)} 个候选 IP -> {args.output} (已知 /24 {len(history["arms"])} 个)')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
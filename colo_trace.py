@@ -0,0 +1,79 @@
+import os
+import time
+import threading
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+from downloader import trace
+from geo_cache import GeoCache, GEO_CACHE_PATH
+from run_report import count
+
+# 数据中心发现：固定连到每个候选 IP 请求 /cdn-cgi/trace，colo= 是实际服务该 IP 的 CF 数据中心 (IATA 代码)。
+# 同一 colo 的 IP 走同一条路由、带宽接近，带宽测试可以每个 colo 先测几个代表，再决定是否铺开。
+COLO_TRACE = os.environ.get('SPEED_COLO_TRACE', '1') != '0'
+COLO_REPS = int(os.environ.get('SPEED_COLO_REPS', '2'))  # 每个 colo 先测几个代表 (按延迟取前几个)，0 表示不分组全测
+COLO_TTL = float(os.environ.get('SPEED_COLO_TTL', str(6 * 3600)))  # 路由会变，缓存比归属地短
+TRACE_CONCURRENCY = int(os.environ.get('SPEED_TRACE_CONCURRENCY', '32'))
+TRACE_TIMEOUT = float(os.environ.get('SPEED_TRACE_TIMEOUT', '3'))
+
+Trace = namedtuple('Trace', 'colo loc')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def trace_cache():
+    """colo 结果与归属地共用 geo_cache.db (kind='colo')，但按单个 IP 缓存、TTL 更短，命中计数记为 colo.cache.*"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = GeoCache(GEO_CACHE_PATH, ttl=COLO_TTL, use_prefix=False, metric='colo.cache')
+        return _cache
+
+
+def discover(tasks, concurrency=None, timeout=None):
+    """并发探测 tasks [(ip, port), ...] 的 colo，返回 {ip: Trace}；探测失败的 IP 不在其中"""
+    concurrency = concurrency or TRACE_CONCURRENCY
+    timeout = timeout or TRACE_TIMEOUT
+    cache = trace_cache()
+    start = time.monotonic()
+
+    def probe(task):
+        ip, port = task
+        hit, value = cache.get('colo', ip)
+        if not hit:
+            fields = trace(ip, timeout=timeout, port=int(port))
+            value = f"{fields['colo']}\x1f{fields.get('loc', '')}" if fields else None
+            cache.put('colo', ip, value)
+        return ip, Trace(*value.split('\x1f')) if value else None, hit
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        probed = list(pool.map(probe, tasks))
+    colos = {ip: t for ip, t, _ in probed if t}
+    cached = sum(hit for _, _, hit in probed)
+    per_colo = Counter(t.colo for t in colos.values())
+    count('colo.unknown', len(tasks) - len(colos))
+    print(f"colo 探测: {len(tasks)} 个 IP (缓存 {cached} 个)，识别 {len(colos)} 个，共 {len(per_colo)} 个数据中心"
+          f"{': ' + ', '.join(f'{c} {n}' for c, n in per_colo.most_common(10)) if per_colo else ''} "
+          f"(用时 {time.monotonic() - start:.1f}s)")
+    return colos
+
+
+def group(tasks, colos, reps=None):
+    """按 colo 分组：每个 colo 取延迟最靠前的 reps 个作为代表 (tasks 已按延迟排序)，colo 未知的 IP 全部先测
+
+    返回 (代表 [(ip, port), ...], {colo: [其余 (ip, port), ...]})
+    """
+    reps = COLO_REPS if reps is None else reps
+    if reps <= 0:
+        return list(tasks), {}
+    first, rest = [], {}
+    seen = Counter()
+    for task in tasks:
+        t = colos.get(task[0])
+        if t is None or seen[t.colo] < reps:
+            first.append(task)
+            if t is not None:
+                seen[t.colo] += 1
+        else:
+            rest.setdefault(t.colo, []).append(task)
+    return first, rest
@@ -0,0 +1,354 @@
+import os
+import ssl
+import time
+import socket
+import subprocess
+import math
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from run_report import observe, count
+
+# CF 官方带宽测试端点
+HOST = 'speed.cloudflare.com'
+PORT = 443
+DOWN_PATH = '/__down?bytes={size}'
+TRACE_PATH = '/cdn-cgi/trace'
+CONNECT_TIMEOUT = 10
+MAX_TIME = 30
+BUFFER_SIZE = 256 * 1024
+
+# 下载后端: native (进程内 socket+ssl) 或 curl (旧的子进程方式，作为备用)
+BACKEND = os.environ.get('SPEED_BACKEND', 'native')
+# 测量方式: adaptive (滑动窗口采样，收敛或明显进不了榜就提前停) 或 full (下载完整文件)
+MEASURE = os.environ.get('SPEED_MEASURE', 'adaptive')
+SAMPLE_WINDOW = 0.2  # 采样窗口 (秒)
+SAMPLE_HISTORY = 10  # 估计速率时使用最近多少个窗口
+SAMPLE_MIN_WINDOWS = 5  # 至少采满这么多窗口才判断收敛
+SAMPLE_REL_CI = float(os.environ.get('SPEED_SAMPLE_REL_CI', '0.05'))  # 95% 置信区间半宽 / 均值 低于此值视为收敛
+SAMPLE_MIN_TIME = 1.0  # 至少测这么久 (秒) 才允许因进不了榜提前放弃
+# 测哪些端口: advertised (ip.txt 里写的端口)、all (CF 全部 HTTPS 端口，取最快的) 或逗号分隔的端口列表
+PORTS = (443, 8443, 2053, 2083, 2087, 2096)
+PORT_MODE = os.environ.get('SPEED_PORTS', 'advertised')
+# 多连接测试: 单流测完后再同时开 STREAMS 条连接测聚合带宽，1 表示只测单流
+STREAMS = int(os.environ.get('SPEED_STREAMS', '1'))
+# 排名依据: single (单流速率) 或 aggregate (多连接聚合速率，STREAMS > 1 时有效)
+RANK_BY = os.environ.get('SPEED_RANK_BY', 'single')
+
+# 单次下载结果；时间单位秒，mbps 为 MB/s (1048576 字节)，variance 为采样窗口速率的方差
+# stopped: '' 正常下载完, 'converged' 速率已收敛提前停, 'below_cutoff' 预计进不了榜提前停
+# error 为空表示传输没有出错
+DownloadResult = namedtuple('DownloadResult', 'ip bytes connect_time handshake_time ttfb elapsed mbps error variance stopped',
+                            defaults=(0.0, ''))
+
+
+class Measurement(namedtuple('Measurement', 'port single aggregate streams')):
+    """一个 IP 的测速结果: 实际测的端口、单流 MB/s、多连接聚合 MB/s (没测为 0) 和连接数"""
+    __slots__ = ()
+
+    @property
+    def speed(self):
+        """排名用的速率，按 RANK_BY 取单流或聚合"""
+        return self.aggregate if RANK_BY == 'aggregate' and self.streams > 1 else self.single
+
+    @property
+    def peak(self):
+        """测试过程中占用的最高带宽，用于总带宽闸门"""
+        return max(self.single, self.aggregate)
+
+
+def ports_for(advertised, mode=None):
+    """按 PORT_MODE 给出要测的端口列表 (int)"""
+    mode = mode or PORT_MODE
+    if mode == 'advertised':
+        return [int(advertised)]
+    if mode == 'all':
+        return [int(advertised)] + [p for p in PORTS if p != int(advertised)]
+    return [int(p) for p in mode.split(',') if p.strip()]
+
+
+# 与 curl --insecure 一致：只固定 SNI/Host，不校验证书 (候选 IP 可能是反代)
+_ssl_context = ssl.create_default_context()
+_ssl_context.check_hostname = False
+_ssl_context.verify_mode = ssl.CERT_NONE
+# 按 IP 保存 TLS 会话，重试或再次测同一 IP 时走会话复用，省掉完整握手
+_tls_sessions = {}
+_tls_lock = threading.Lock()
+_local = threading.local()
+
+
+def _buffer():
+    """每个线程复用同一块接收缓冲区，数据读完即丢弃，不落盘"""
+    buf = getattr(_local, 'buf', None)
+    if buf is None:
+        buf = _local.buf = memoryview(bytearray(BUFFER_SIZE))
+    return buf
+
+
+class ThroughputSampler:
+    """按固定窗口统计下载速率，判断估计值是否已收敛，或者乐观估计也够不上入榜线
+
+    cutoff: 返回当前入榜最低速率 (MB/s) 的函数，没有门槛时返回 0
+    """
+
+    def __init__(self, cutoff=None, window=SAMPLE_WINDOW, history=SAMPLE_HISTORY,
+                 min_windows=SAMPLE_MIN_WINDOWS, rel_ci=SAMPLE_REL_CI, min_time=SAMPLE_MIN_TIME):
+        self.cutoff = cutoff
+        self.window = window
+        self.rates = deque(maxlen=history)
+        self.min_windows = min_windows
+        self.rel_ci = rel_ci
+        self.min_time = min_time
+        self.start = self.window_start = None
+        self.window_bytes = 0
+
+    def feed(self, n, now):
+        """记录新收到的 n 字节；需要停止时返回停止原因"""
+        if self.start is None:
+            self.start = self.window_start = now
+        self.window_bytes += n
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return None
+        self.rates.append(self.window_bytes / elapsed / 1048576)
+        self.window_start = now
+        self.window_bytes = 0
+        mean, variance = self.estimate()
+        half_width = 1.96 * math.sqrt(variance / len(self.rates))
+        if len(self.rates) >= self.min_windows and mean > 0 and half_width <= self.rel_ci * mean:
+            return 'converged'
+        if self.cutoff and now - self.start >= self.min_time:
+            cutoff = self.cutoff()
+            if cutoff and mean + half_width < cutoff:
+                return 'below_cutoff'
+        return None
+
+    def estimate(self):
+        """返回最近窗口速率的 (均值, 方差)，单位 MB/s"""
+        n = len(self.rates)
+        if not n:
+            return 0.0, 0.0
+        mean = sum(self.rates) / n
+        variance = sum((r - mean) ** 2 for r in self.rates) / (n - 1) if n > 1 else 0.0
+        return mean, variance
+
+
+def _result(ip, received, t0, t_conn, t_tls, t_first, t_end, error, sampler=None, stopped=''):
+    transfer = t_end - t_first if t_first else 0
+    mbps = received / transfer / 1048576 if transfer > 0 else 0.0
+    variance = 0.0
+    if sampler is not None and sampler.rates:
+        mbps, variance = sampler.estimate()
+    return DownloadResult(ip, received,
+                          t_conn - t0 if t_conn else 0.0,
+                          t_tls - t_conn if t_tls else 0.0,
+                          t_first - t_tls if t_first else 0.0,
+                          t_end - t0, mbps, error, variance, stopped)
+
+
+def native_download(ip, size, deadline=None, host=HOST, port=PORT, sampler=None):
+    """进程内下载：TCP 直连 ip:port，SNI/Host 设为 host (等同 curl --resolve host:port:ip)
+
+    吞吐量按首字节到结束计算，不含建连/握手；传入 sampler 时按其判断提前停止，
+    速率取最近采样窗口的均值。
+    """
+    deadline = deadline or time.monotonic() + MAX_TIME
+    t0 = time.monotonic()
+    t_conn = t_tls = t_first = None
+    received = 0
+    sock = None
+    try:
+        sock = socket.create_connection((ip, port), timeout=min(CONNECT_TIMEOUT, max(deadline - t0, 0.1)))
+        t_conn = time.monotonic()
+        with _tls_lock:
+            session = _tls_sessions.get((ip, port))
+        sock = _ssl_context.wrap_socket(sock, server_hostname=host, session=session)
+        t_tls = time.monotonic()
+        with _tls_lock:
+            _tls_sessions[(ip, port)] = sock.session
+        request = (f'GET {DOWN_PATH.format(size=size)} HTTP/1.1\r\nHost: {host}\r\n'
+                   f'User-Agent: curl/8.0\r\nAccept: */*\r\nConnection: close\r\n\r\n')
+        sock.sendall(request.encode())
+
+        buf = _buffer()
+        header = b''
+        body_left = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return _result(ip, received, t0, t_conn, t_tls, t_first, time.monotonic(), 'timeout', sampler)
+            sock.settimeout(remaining)
+            n = sock.recv_into(buf)
+            if not n:
+                break
+            if t_first is None:
+                t_first = time.monotonic()
+            if body_left is None:
+                # 还在读响应头
+                header += bytes(buf[:n])
+                end = header.find(b'\r\n\r\n')
+                if end < 0:
+                    continue
+                status = header.split(b'\r\n', 1)[0].split()
+                if len(status) < 2 or status[1] != b'200':
+                    return _result(ip, 0, t0, t_conn, t_tls, t_first, time.monotonic(),
+                                   f'http {status[1].decode() if len(status) > 1 else "?"}')
+                body_left = -1  # 无 Content-Length 时读到连接关闭
+                for line in header[:end].split(b'\r\n')[1:]:
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        body_left = int(value)
+                n = len(header) - end - 4
+                t_first = time.monotonic()  # 吞吐量从响应体开始算
+            received += n
+            if sampler is not None:
+                stopped = sampler.feed(n, time.monotonic())
+                if stopped:
+                    return _result(ip, received, t0, t_conn, t_tls, t_first, time.monotonic(), '', sampler, stopped)
+            if body_left >= 0 and received >= body_left:
+                break
+        return _result(ip, received, t0, t_conn, t_tls, t_first, time.monotonic(), '', sampler)
+    except Exception as e:
+        return _result(ip, received, t0, t_conn, t_tls, t_first, time.monotonic(), f'{type(e).__name__}: {e}', sampler)
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def curl_download(ip, size, deadline=None, host=HOST, port=PORT):
+    """curl 子进程后端，输出与 native_download 相同的 DownloadResult"""
+    max_time = MAX_TIME
+    if deadline is not None:
+        max_time = min(max_time, int(deadline - time.monotonic()))
+        if max_time <= 0:
+            return DownloadResult(ip, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 'timeout')
+    cmd = [
+        'curl', '-s',
+        '--resolve', f'{host}:{port}:[{ip}]' if ':' in ip else f'{host}:{port}:{ip}',
+        f'https://{host}:{port}{DOWN_PATH.format(size=size)}',
+        '-o', '/dev/null',
+        '-w', '%{size_download} %{time_connect} %{time_appconnect} %{time_starttransfer} %{time_total}',
+        '--max-time', str(max_time),
+        '--connect-timeout', str(min(CONNECT_TIMEOUT, max_time)),
+        '--insecure'
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=max_time + 10)
+    except subprocess.TimeoutExpired:
+        return DownloadResult(ip, 0, 0.0, 0.0, 0.0, float(max_time), 0.0, 'timeout')
+    try:
+        size_dl, t_conn, t_tls, t_first, t_total = (float(x) for x in result.stdout.split())
+    except ValueError:
+        return DownloadResult(ip, 0, 0.0, 0.0, 0.0, 0.0, 0.0, result.stderr.strip() or 'bad curl output')
+    transfer = t_total - t_first
+    mbps = size_dl / transfer / 1048576 if transfer > 0 else 0.0
+    error = '' if result.returncode == 0 else f'curl code {result.returncode}'
+    return DownloadResult(ip, int(size_dl), t_conn, t_tls - t_conn, t_first - t_tls, t_total, mbps, error)
+
+
+def download(ip, size, deadline=None, host=HOST, port=PORT, backend=None, cutoff=None):
+    """按 BACKEND 选择下载实现；native 后端在 MEASURE=adaptive 时采样并可提前停止
+
+    cutoff: 返回当前入榜最低速率的函数，用于提前放弃明显进不了榜的 IP
+    """
+    if (backend or BACKEND) == 'curl':
+        result = curl_download(ip, size, deadline, host, port)
+    else:
+        sampler = ThroughputSampler(cutoff) if MEASURE == 'adaptive' else None
+        result = native_download(ip, size, deadline, host, port, sampler)
+    _report(result)
+    return result
+
+
+def _report(r):
+    """把一次下载的各阶段耗时和结束原因记入运行报告"""
+    if r.connect_time:
+        observe('speed.connect', r.connect_time)
+    if r.handshake_time:
+        observe('speed.tls', r.handshake_time)
+    if r.ttfb:
+        observe('speed.ttfb', r.ttfb)
+    observe('speed.download', r.elapsed, ip=r.ip, mbps=round(r.mbps, 1), error=r.error)
+    if r.error:
+        count(f'speed.error.{r.error.split(":", 1)[0].replace(" ", "_")}')
+    else:
+        count(f'speed.stopped.{r.stopped or "complete"}')
+
+
+def multi_download(ip, size, streams, deadline=None, host=HOST, port=PORT, backend=None):
+    """同时开 streams 条连接，每条各下载 size 字节，返回聚合的 DownloadResult
+
+    各连接并发开始、各自采样收敛即停，mbps 为各连接速率之和，bytes 为总字节数；
+    只要有一条连接成功就不算出错。
+    """
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        results = list(pool.map(lambda _: download(ip, size, deadline, host, port, backend), range(streams)))
+    ok = [r for r in results if not r.error]
+    return DownloadResult(ip, sum(r.bytes for r in results),
+                          max(r.connect_time for r in results),
+                          max(r.handshake_time for r in results),
+                          max(r.ttfb for r in results),
+                          max(r.elapsed for r in results),
+                          sum(r.mbps for r in ok),
+                          '' if ok else results[0].error,
+                          sum(r.variance for r in ok))
+
+
+def trace(ip, timeout=3, host=HOST, port=PORT):
+    """连到 ip:port 请求 /cdn-cgi/trace，返回 {键: 值} (含 colo=实际服务的数据中心, loc=)；不通或不是 CF 返回 None"""
+    sock = None
+    start = time.monotonic()
+    try:
+        sock = socket.create_connection((ip, port), timeout=timeout)
+        with _tls_lock:
+            session = _tls_sessions.get((ip, port))
+        sock = _ssl_context.wrap_socket(sock, server_hostname=host, session=session)
+        with _tls_lock:
+            _tls_sessions[(ip, port)] = sock.session
+        # HTTP/1.0: 响应不分块，读到连接关闭即可
+        sock.sendall(f'GET {TRACE_PATH} HTTP/1.0\r\nHost: {host}\r\nUser-Agent: curl/8.0\r\nAccept: */*\r\n\r\n'.encode())
+        data = b''
+        while len(data) < 65536:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        head, _, body = data.partition(b'\r\n\r\n')
+        status = head.split(b'\r\n', 1)[0].split()
+        if len(status) < 2 or status[1] != b'200':
+            count('trace.error.http')
+            return None
+        fields = dict(line.split('=', 1) for line in body.decode('utf-8', 'replace').splitlines() if '=' in line)
+        observe('trace', time.monotonic() - start)
+        return fields if fields.get('colo') else None
+    except Exception as e:
+        count(f'trace.error.{type(e).__name__}')
+        return None
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def probe_latency(ip, timeout=3, host=HOST, port=PORT):
+    """只做 TCP 建连 + TLS 握手，返回 (建连毫秒, 握手毫秒)；不通返回 None
+
+    握手得到的 TLS 会话会保存下来，随后对该 IP 的下载可直接复用。
+    """
+    sock = None
+    try:
+        t0 = time.monotonic()
+        sock = socket.create_connection((ip, port), timeout=timeout)
+        t_conn = time.monotonic()
+        sock = _ssl_context.wrap_socket(sock, server_hostname=host)
+        t_tls = time.monotonic()
+        with _tls_lock:
+            _tls_sessions[(ip, port)] = sock.session
+        observe('probe.tcp', t_conn - t0)
+        observe('probe.tls', t_tls - t_conn)
+        return (t_conn - t0) * 1000, (t_tls - t_conn) * 1000
+    except Exception as e:
+        count(f'probe.error.{type(e).__name__}')
+        return None
+    finally:
+        if sock is not None:
+            sock.close()
@@ -0,0 +1,211 @@
+import time
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from geo_cache import default_cache, ip_prefix, GEO_CACHE_PREFIX
+from run_report import span, observe, count, log
+
+# ip-api.com 批量接口：每次 POST 最多 100 个 IP
+IP_API_BATCH_URL = 'http://ip-api.com/batch'
+IP_API_BATCH_SIZE = 100
+IP_API_FIELDS = 'status,message,query,country,countryCode,city,as'
+FALLBACK_CONCURRENCY = 4  # 批量失败的 IP 走备用 API 时的并发数
+
+
+def _retry_seconds(value, default):
+    """X-Ttl / Retry-After 头 -> 等待秒数：可以是秒数，也可以是 HTTP 日期；缺失或无法解析时返回 default"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class ProviderLimit:
+    """按服务商的限速控制请求节奏：令牌桶限制平均速率，再按返回的限流头暂停
+
+    rate: 每秒允许的请求数 (令牌桶，容量 burst)，None 表示只看限流头；
+    ip-api.com: X-Rl = 当前窗口剩余请求数, X-Ttl = 窗口重置剩余秒数；
+    其他服务商遇到 429 时按 Retry-After 等待，没有该头则指数退避。
+    多个线程共用同一个实例即可共享配额。
+    """
+
+    def __init__(self, name, rate=None, burst=1):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.resume_at = 0.0
+        self.backoff = 1.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """阻塞到可以发下一个请求"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.resume_at - now
+                if delay <= 0 and self.rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+                    self.refilled_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+                elif delay <= 0:
+                    return
+            if delay > 1:
+                observe(f'geo.wait.{self.name}', delay)
+                log(f"  {self.name} 限流，等待 {delay:.0f}s...")
+            time.sleep(delay)
+
+    def update(self, response):
+        """根据响应调整节奏；返回 True 表示被限流 (429)，调用方可稍后重试"""
+        headers = response.headers
+        pause = 0.0
+        limited = response.status_code == 429
+        if limited:
+            count(f'geo.rate_limited.{self.name}')
+            retry_after = headers.get('X-Ttl') or headers.get('Retry-After')
+            with self.lock:
+                pause = _retry_seconds(retry_after, self.backoff)
+                self.backoff = min(self.backoff * 2, 60)
+        else:
+            with self.lock:
+                self.backoff = 1.0
+            if headers.get('X-Rl') == '0':
+                pause = _retry_seconds(headers.get('X-Ttl'), 60)
+        if pause > 0:
+            with self.lock:
+                self.resume_at = max(self.resume_at, time.monotonic() + pause)
+        return limited
+
+
+ip_api_limit = ProviderLimit('ip-api.com', rate=15 / 60, burst=15)  # 免费版每分钟 15 次批量请求
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """归属地查询共用的连接池会话 (各备用 API 复用 keep-alive 连接)"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=FALLBACK_CONCURRENCY * 2)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def ip_api_batch(ips, lang=None, retries=2, fields=IP_API_FIELDS):
+    """批量查询 ip-api.com，返回 {ip: 记录}；只包含 status == success 的 IP"""
+    params = {'fields': fields}
+    if lang:
+        params['lang'] = lang
+    found = {}
+    for i in range(0, len(ips), IP_API_BATCH_SIZE):
+        chunk = ips[i:i + IP_API_BATCH_SIZE]
+        for attempt in range(retries + 1):
+            if attempt:
+                count('geo.ip-api.batch.retry')
+            ip_api_limit.wait()
+            try:
+                with span('geo.ip-api.batch'):
+                    resp = session().post(IP_API_BATCH_URL, params=params, json=chunk, timeout=10)
+            except Exception as e:
+                log(f"  ip-api.com 批量查询异常 ({len(chunk)} 个 IP): {e}")
+                continue
+            ip_api_limit.update(resp)
+            if resp.status_code == 429:
+                continue
+            if resp.status_code != 200:
+                count(f'geo.ip-api.batch.status_{resp.status_code}')
+                log(f"  ip-api.com 批量查询失败: {resp.status_code}")
+                break
+            try:
+                records = resp.json()
+            except ValueError as e:
+                # 200 但不是 JSON (如代理/验证页)：这一组交给备用链，不中断整个预取
+                count('geo.ip-api.batch.bad_json')
+                log(f"  ip-api.com 批量响应无法解析 ({len(chunk)} 个 IP): {e}")
+                break
+            for record in records if isinstance(records, list) else ():
+                if isinstance(record, dict) and record.get('status') == 'success':
+                    found[record.get('query')] = record
+            break
+    return found
+
+
+def prefetch(ips, kind, extract, fallback, lang=None, failures=('未知',),
+             share_prefix=GEO_CACHE_PREFIX, concurrency=FALLBACK_CONCURRENCY, local=None, fields=IP_API_FIELDS):
+    """批量解析一组 IP 并写入归属地缓存 (kind 与 geo_cache.cached 使用的一致)
+
+    ips 可以是任意可迭代对象 (如生成器)，只遍历一次；调用方负责去重
+
+    extract(ip-api 记录) -> 值，取不到返回 None
+    fallback(ip) -> 值：批量接口没给出结果的 IP 才调用，用备用服务商并发查询
+    share_prefix: 同一 /24 (v4) 或 /48 (v6) 只查一个代表 IP，结果套用到整组
+    local(ip) -> 值或 None：离线索引能回答的 IP 不再远程查询 (与 cached 的 local 一致)
+    fields: ip-api.com 返回的字段
+    之后对同一 kind 的单 IP 查询都会直接命中缓存。
+    """
+    cache = default_cache()
+    groups = {}  # 代表键 -> 组内未命中缓存的 IP
+    local_hits = 0
+    total = 0
+    for ip in ips:
+        total += 1
+        if local is not None and local(ip):
+            local_hits += 1
+            continue
+        hit, _ = cache.get(kind, ip)
+        if not hit:
+            key = (ip_prefix(ip) or ip) if share_prefix else ip
+            groups.setdefault(key, []).append(ip)
+    if not groups:
+        print(f"批量归属地: {total} 个 IP 全部命中离线索引/缓存 (离线索引 {local_hits} 个)")
+        return
+
+    def store(members, value):
+        for ip in members:
+            cache.put(kind, ip, None if value in failures else value)
+
+    representatives = [members[0] for members in groups.values()]
+    records = ip_api_batch(representatives, lang=lang, fields=fields)
+    failed = []
+    for members in groups.values():
+        record = records.get(members[0])
+        value = extract(record) if record else None
+        if value and value not in failures:
+            store(members, value)
+        else:
+            failed.append(members)
+
+    def run_fallback(members):
+        try:
+            with span('geo.fallback'):
+                value = fallback(members[0])
+        except Exception as e:
+            log(f"  备用查询异常 {members[0]}: {e}")
+            value = failures[0]
+        store(members, value)
+
+    if failed:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run_fallback, failed))
+    count('geo.prefetch.local_hit', local_hits)
+    count('geo.prefetch.batch_ok', len(groups) - len(failed))
+    count('geo.prefetch.fallback', len(failed))
+    pending = sum(len(members) for members in groups.values())
+    print(f"批量归属地: 离线索引命中 {local_hits} 个，待查 {pending} 个 IP (按前缀合并为 {len(groups)} 组)，"
+          f"ip-api.com 批量成功 {len(groups) - len(failed)} 组，备用 API 补查 {len(failed)} 组")
@@ -0,0 +1,144 @@
+import os
+import time
+import sqlite3
+import threading
+import functools
+import ipaddress
+from run_report import count
+
+# 归属地缓存配置 (可用环境变量覆盖)
+GEO_CACHE_PATH = os.environ.get('GEO_CACHE_PATH', 'geo_cache.db')
+GEO_CACHE_TTL = float(os.environ.get('GEO_CACHE_TTL', str(14 * 86400)))  # 成功结果保留 14 天
+GEO_CACHE_NEGATIVE_TTL = float(os.environ.get('GEO_CACHE_NEGATIVE_TTL', '3600'))  # 失败结果 1 小时后重查
+GEO_CACHE_PREFIX = os.environ.get('GEO_CACHE_PREFIX', '1') != '0'  # 同 /24 (v4) 或 /48 (v6) 共享结果
+
+PREFIX_V4 = 24
+PREFIX_V6 = 48
+
+
+def ip_prefix(ip):
+    """返回 IP 所在覆盖前缀，如 104.16.10.82 -> 104.16.10.0/24；非法 IP 返回 None"""
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    bits = PREFIX_V4 if addr.version == 4 else PREFIX_V6
+    return str(ipaddress.ip_network(f'{addr}/{bits}', strict=False))
+
+
+class GeoCache:
+    """SQLite 持久化的 IP 归属地缓存：按 IP 和覆盖前缀索引，支持 TTL、失败结果缓存和命中计数
+
+    kind 区分不同查询 (如 'city_zh'、'country_zh'、'country_code')，互不干扰。
+    value 为 None 表示一次失败的查询 (负缓存)，使用较短的 TTL。
+    metric: run_report 计数的前缀，共用数据库的其他缓存 (如 colo) 用自己的前缀，不混进归属地计数。
+    """
+
+    def __init__(self, path=GEO_CACHE_PATH, ttl=GEO_CACHE_TTL, negative_ttl=GEO_CACHE_NEGATIVE_TTL,
+                 use_prefix=GEO_CACHE_PREFIX, metric='geo.cache'):
+        self.path = path
+        self.metric = metric
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.use_prefix = use_prefix
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)  # 分片测速时多个进程共用
+        self.conn.execute('CREATE TABLE IF NOT EXISTS geo ('
+                          'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires REAL NOT NULL, '
+                          'PRIMARY KEY (kind, key))')
+        self.conn.commit()
+        self.hits = 0
+        self.prefix_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, kind, ip):
+        """返回 (是否命中, 值)；命中负缓存时值为 None"""
+        now = time.time()
+        prefix = ip_prefix(ip) if self.use_prefix else None
+        with self.lock:
+            row = self.conn.execute('SELECT value, expires FROM geo WHERE kind = ? AND key = ?',
+                                    (kind, ip)).fetchone()
+            if row and row[1] > now:
+                if row[0] is None:
+                    self.negative_hits += 1
+                    count(f'{self.metric}.negative_hit')
+                else:
+                    self.hits += 1
+                    count(f'{self.metric}.hit')
+                return True, row[0]
+            if prefix:
+                row = self.conn.execute('SELECT value, expires FROM geo WHERE kind = ? AND key = ?',
+                                        (kind, prefix)).fetchone()
+                if row and row[1] > now:
+                    self.prefix_hits += 1
+                    count(f'{self.metric}.prefix_hit')
+                    return True, row[0]
+            self.misses += 1
+            count(f'{self.metric}.miss')
+            return False, None
+
+    def put(self, kind, ip, value):
+        """写入结果；value 为 None 记为失败 (负缓存)，成功结果同时写入前缀行"""
+        now = time.time()
+        expires = now + (self.negative_ttl if value is None else self.ttl)
+        rows = [(kind, ip, value, expires)]
+        if value is not None and self.use_prefix:
+            prefix = ip_prefix(ip)
+            if prefix:
+                rows.append((kind, prefix, value, expires))
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO geo (kind, key, value, expires) VALUES (?, ?, ?, ?)', rows)
+            self.conn.commit()
+
+    def purge(self):
+        """删除过期条目"""
+        with self.lock:
+            self.conn.execute('DELETE FROM geo WHERE expires <= ?', (time.time(),))
+            self.conn.commit()
+
+    def stats(self):
+        return (f'归属地缓存: 命中 {self.hits}, 前缀命中 {self.prefix_hits}, '
+                f'失败缓存命中 {self.negative_hits}, 未命中 {self.misses}')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """进程内共享的缓存实例 (首次使用时打开，并清理过期条目)"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = GeoCache()
+            _default_cache.purge()
+        return _default_cache
+
+
+def cached(kind, failures=('未知',), local=None):
+    """装饰 IP 查询函数 fn(ip) -> str：先查缓存，未命中再调用原函数并写回
+
+    返回值在 failures 中视为查询失败，按负缓存 TTL 保存；命中负缓存时直接返回 failures[0]。
+    local(ip) -> 值或 None：离线数据 (如 geo_index 前缀索引)，有结果时连缓存都不查。
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(ip):
+            if local is not None:
+                value = local(ip)
+                if value:
+                    return value
+            cache = default_cache()
+            hit, value = cache.get(kind, ip)
+            if hit:
+                return failures[0] if value is None else value
+            value = fn(ip)
+            cache.put(kind, ip, None if value in failures else value)
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,203 @@
+"""离线前缀归属地索引：CIDR -> (国家代码, 城市, colo)，最长前缀匹配
+
+源数据为 CSV，每行 `CIDR,国家代码,城市(英文),colo`，# 开头为注释；
+也接受 busi.txt 这样只有网段基址的行 (IPv4 视为 /16、IPv6 视为 /32，标签取命令行默认值)。
+构建时把嵌套网段展开成互不重叠的区间 (更具体的网段优先)，写成紧凑二进制文件，
+运行时 mmap 后二分查找，单次查询为微秒级，不需要联网。
+
+构建: python geo_index.py build geo_prefixes.csv [-o geo_index.bin] [--country US] [--colo SJC]
+查询: python geo_index.py lookup 104.16.10.82
+"""
+import os
+import sys
+import mmap
+import struct
+import argparse
+import threading
+import ipaddress
+from collections import namedtuple
+
+GEO_INDEX_PATH = os.environ.get('GEO_INDEX_PATH', 'geo_index.bin')
+MAGIC = b'GIX1'
+_HEADER = struct.Struct('<4sIII')  # magic, IPv4 区间数, IPv6 区间数, 标签数
+_V4 = struct.Struct('<III')  # 起始, 结束, 标签序号
+_V6 = struct.Struct('<QQQQI')  # 起始高/低 64 位, 结束高/低 64 位, 标签序号
+_LABEL_LEN = struct.Struct('<H')
+BARE_PREFIX_LEN = 16  # busi.txt 里只写网段基址时 IPv4 按 /16、IPv6 按 /32 处理
+BARE_PREFIX_LEN_V6 = 32
+
+GeoRecord = namedtuple('GeoRecord', 'country city colo')
+
+
+def _flatten(networks):
+    """[(起始, 结束, 标签)] (CIDR 只会嵌套或不相交) -> 互不重叠的区间，内层网段覆盖外层"""
+    networks = sorted(networks, key=lambda n: (n[0], -n[1]))  # 同起点时大网段在前
+    out = []
+    stack = []  # 当前嵌套链上的 (结束, 标签)
+    cur = None
+
+    def emit(start, end, label):
+        if start > end:
+            return
+        if out and out[-1][2] == label and out[-1][1] + 1 == start:
+            out[-1] = (out[-1][0], end, label)  # 合并相邻同标签区间
+        else:
+            out.append((start, end, label))
+
+    for start, end, label in networks:
+        while stack and stack[-1][0] < start:
+            top_end, top_label = stack.pop()
+            emit(cur, top_end, top_label)
+            cur = top_end + 1
+        if stack:
+            emit(cur, start - 1, stack[-1][1])
+        stack.append((end, label))
+        cur = start
+    while stack:
+        top_end, top_label = stack.pop()
+        emit(cur, top_end, top_label)
+        cur = top_end + 1
+    return out
+
+
+def parse_source(lines, country='', city='', colo=''):
+    """读源数据行，返回 (IPv4 网段列表, IPv6 网段列表)，每项为 (起始, 结束, (国家, 城市, colo))"""
+    v4, v6 = {}, {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [f.strip() for f in line.split(',')]
+        cidr = fields[0].strip('[]')
+        if '/' not in cidr:
+            cidr = f'{cidr}/{BARE_PREFIX_LEN_V6 if ":" in cidr else BARE_PREFIX_LEN}'
+        try:
+            net = ipaddress.ip_network(cidr, strict=False)
+        except ValueError:
+            print(f'跳过无效网段: {line}')
+            continue
+        label = (fields[1] if len(fields) > 1 else country,
+                 fields[2] if len(fields) > 2 else city,
+                 fields[3] if len(fields) > 3 else colo)
+        target = v4 if net.version == 4 else v6
+        target[(int(net.network_address), int(net.broadcast_address))] = label  # 重复网段以后出现的为准
+    return ([(s, e, label) for (s, e), label in v4.items()],
+            [(s, e, label) for (s, e), label in v6.items()])
+
+
+def build(v4_networks, v6_networks, path=GEO_INDEX_PATH):
+    """把网段写成二进制索引文件"""
+    labels = {}
+    v4 = [(s, e, labels.setdefault(label, len(labels))) for s, e, label in v4_networks]
+    v6 = [(s, e, labels.setdefault(label, len(labels))) for s, e, label in v6_networks]
+    v4 = _flatten(v4)
+    v6 = _flatten(v6)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, len(v4), len(v6), len(labels)))
+        for s, e, label in v4:
+            f.write(_V4.pack(s, e, label))
+        for s, e, label in v6:
+            f.write(_V6.pack(s >> 64, s & 0xFFFFFFFFFFFFFFFF, e >> 64, e & 0xFFFFFFFFFFFFFFFF, label))
+        for label in labels:
+            data = '\x1f'.join(label).encode('utf-8')
+            f.write(_LABEL_LEN.pack(len(data)))
+            f.write(data)
+    os.replace(tmp, path)
+    return len(v4), len(v6), len(labels)
+
+
+class GeoIndex:
+    """mmap 加载的索引文件；lookup 返回 GeoRecord，未覆盖返回 None"""
+
+    def __init__(self, path=GEO_INDEX_PATH):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n4, self.n6, n_labels = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a geo index file')
+        self.v4_offset = _HEADER.size
+        self.v6_offset = self.v4_offset + self.n4 * _V4.size
+        offset = self.v6_offset + self.n6 * _V6.size
+        self.labels = []
+        for _ in range(n_labels):
+            (length,) = _LABEL_LEN.unpack_from(self.mm, offset)
+            offset += _LABEL_LEN.size
+            fields = bytes(self.mm[offset:offset + length]).decode('utf-8').split('\x1f')
+            self.labels.append(GeoRecord(*fields))
+            offset += length
+
+    def _search(self, value, count, base, record, start_of):
+        lo, hi = 0, count
+        while lo < hi:  # 找最后一个起始 <= value 的区间
+            mid = (lo + hi) // 2
+            if start_of(record.unpack_from(self.mm, base + mid * record.size)) <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        return record.unpack_from(self.mm, base + (lo - 1) * record.size)
+
+    def lookup(self, ip):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        value = int(addr)
+        if addr.version == 4:
+            row = self._search(value, self.n4, self.v4_offset, _V4, lambda r: r[0])
+            if row and value <= row[1]:
+                return self.labels[row[2]]
+        else:
+            row = self._search(value, self.n6, self.v6_offset, _V6, lambda r: (r[0] << 64) | r[1])
+            if row and value <= ((row[2] << 64) | row[3]):
+                return self.labels[row[4]]
+        return None
+
+
+_default_index = None
+_default_lock = threading.Lock()
+
+
+def lookup(ip):
+    """查默认索引文件 (GEO_INDEX_PATH)；文件不存在或未覆盖时返回 None，调用方回退到远程 API"""
+    global _default_index
+    with _default_lock:
+        if _default_index is None:
+            _default_index = GeoIndex(GEO_INDEX_PATH) if os.path.exists(GEO_INDEX_PATH) else False
+    return _default_index.lookup(ip) if _default_index else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='离线前缀归属地索引')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_build = sub.add_parser('build', help='从 CSV / busi.txt 构建索引')
+    p_build.add_argument('sources', nargs='+')
+    p_build.add_argument('-o', '--output', default=GEO_INDEX_PATH)
+    p_build.add_argument('--country', default='', help='源数据行没写国家时的默认值')
+    p_build.add_argument('--city', default='')
+    p_build.add_argument('--colo', default='')
+    p_lookup = sub.add_parser('lookup', help='查询 IP')
+    p_lookup.add_argument('ips', nargs='+')
+    p_lookup.add_argument('-i', '--index', default=GEO_INDEX_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        v4, v6 = [], []
+        for source in args.sources:
+            with open(source, 'r', encoding='utf-8') as f:
+                a, b = parse_source(f, args.country, args.city, args.colo)
+            v4 += a
+            v6 += b
+        n4, n6, n_labels = build(v4, v6, args.output)
+        print(f'{args.output}: {n4} 个 IPv4 区间, {n6} 个 IPv6 区间, {n_labels} 个标签, '
+              f'{os.path.getsize(args.output)} 字节')
+    else:
+        index = GeoIndex(args.index)
+        for ip in args.ips:
+            print(ip, index.lookup(ip))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+import os
+from collections import namedtuple
+import geo_index
+from geo_cache import cached
+from geo_batch import prefetch, ProviderLimit, session, FALLBACK_CONCURRENCY, IP_API_FIELDS
+from run_report import span, count, log
+
+# 统一归属地解析：每个 IP 只向一个服务商查一次，拿到国家、城市、ASN (离线索引另有 colo)，
+# 整条记录缓存；中文城市、中文国家、国家代码等标签都由同一条记录按需渲染，不再分别查询。
+# ip-api.com 用 lang=zh-CN 查询，直接给出中文国家名和城市名；备用服务商和离线索引只有英文，查下面的表翻译。
+
+# 英文城市 → 中文映射 (各服务商统一按英文查询，再查此表翻译)
+EN_CITY_TO_CN = {
+    'San Francisco': '旧金山',
+    'New York': '纽约',
+    'Los Angeles': '洛杉矶',
+    'Chicago': '芝加哥',
+    'Houston': '休斯顿',
+    'Phoenix': '凤凰城',
+    'Philadelphia': '费城',
+    'San Antonio': '圣安东尼奥',
+    'San Diego': '圣迭戈',
+    'Dallas': '达拉斯',
+    'Seattle': '西雅图',
+    'Denver': '丹佛',
+    'Washington': '华盛顿',
+    'Boston': '波士顿',
+    'Detroit': '底特律',
+    'Nashville': '纳什维尔',
+    'Portland': '波特兰',
+    'Las Vegas': '拉斯维加斯',
+    'Memphis': '孟菲斯',
+    'Oklahoma City': '俄克拉荷马城',
+    'Baltimore': '巴尔的摩',
+    'Milwaukee': '密尔沃基',
+    'Albuquerque': '阿尔伯克基',
+    'Tucson': '图森',
+    'Fresno': '弗雷斯诺',
+    'Sacramento': '萨克拉门托',
+    'Long Beach': '长滩',
+    'Kansas City': '堪萨斯城',
+    'Mesa': '梅萨',
+    'Atlanta': '亚特兰大',
+    'Colorado Springs': '科罗拉多斯普林斯',
+    'Virginia Beach': '弗吉尼亚比奇',
+    'Raleigh': '罗利',
+    'Omaha': '奥马哈',
+    'Miami': '迈阿密',
+    'Oakland': '奥克兰',
+    'Minneapolis': '明尼阿波利斯',
+    'Tulsa': '塔尔萨',
+    'Cleveland': '克利夫兰',
+    'Wichita': '威奇托',
+    'Arlington': '阿灵顿',
+    # CF 节点常见城市
+    'Tokyo': '东京',
+    'Osaka': '大阪',
+    'Singapore': '新加坡',
+    'Hong Kong': '香港',
+    'Taipei': '台北',
+    'Seoul': '首尔',
+    'Frankfurt': '法兰克福',
+    'Frankfurt am Main': '法兰克福',
+    'London': '伦敦',
+    'Amsterdam': '阿姆斯特丹',
+    'Paris': '巴黎',
+    'Toronto': '多伦多',
+    'Sydney': '悉尼',
+    'San Jose': '圣何塞',
+    'Ashburn': '阿什本',
+    # 加更多如果需要
+    'Unknown': '未知'
+}
+
+
+# 国家映射：支持 code (US) 和 full name (United States)
+EN_TO_CN = {
+    # Codes
+    'US': '美国',
+    'CA': '加拿大',
+    'CN': '中国',
+    'GB': '英国',
+    'DE': '德国',
+    'FR': '法国',
+    'JP': '日本',
+    'AU': '澳大利亚',
+    'IN': '印度',
+    'BR': '巴西',
+    'RU': '俄罗斯',
+    'KR': '韩国',
+    'NL': '荷兰',
+    'SG': '新加坡',
+    'HK': '香港',
+    'TW': '台湾',
+    # Full names (fallback)
+    'United States': '美国',
+    'Canada': '加拿大',
+    'China': '中国',
+    'United Kingdom': '英国',
+    'Germany': '德国',
+    'France': '法国',
+    'Japan': '日本',
+    'Australia': '澳大利亚',
+    'India': '印度',
+    'Brazil': '巴西',
+    'Russia': '俄罗斯',
+    'South Korea': '韩国',
+    'Netherlands': '荷兰',
+    'Singapore': '新加坡',
+    'Hong Kong': '香港',
+    'Taiwan': '台湾',
+    'Reserved': '预留',
+    'Global': '全球',
+    'Unknown': '未知'
+}
+
+# 一个 IP 的归属地原始信息，缺失的字段为空字符串；country/city 为英文 (备用服务商、离线索引)，
+# country_zh/city_zh 为 ip-api.com 给出的中文名
+GeoInfo = namedtuple('GeoInfo', 'country_code country city asn colo country_zh city_zh', defaults=('', ''))
+UNKNOWN = GeoInfo('', '', '', '', '')
+GEO_KIND = 'geo_info_zh'  # 缓存 kind；旧的 'geo_info' 条目没有中文名，换 kind 让它们重新查询
+IP_API_LANG = 'zh-CN'
+
+IPINFO_TOKEN = os.environ.get('IPINFO_TOKEN', '6f75ff6b8f013b')
+# ipinfo 查询节奏: 令牌桶控制平均速率 (IPINFO_RATE 次/秒)，遇到 429 退避后重试
+IPINFO_RATE = float(os.environ.get('IPINFO_RATE', '10'))
+ipinfo_limit = ProviderLimit('ipinfo.io', rate=IPINFO_RATE, burst=IPINFO_RATE)
+
+# 可渲染的标签粒度
+LABELS = {
+    'city': lambda info: info.city_zh or EN_CITY_TO_CN.get(info.city, info.city) or '未知',
+    'country': lambda info: (EN_TO_CN.get(info.country_code) or info.country_zh or EN_TO_CN.get(info.country)
+                             or info.country or info.country_code or '未知'),
+    'country_code': lambda info: info.country_code or 'ZZ',
+    'asn': lambda info: info.asn or '未知',
+    'colo': lambda info: info.colo or '未知',
+}
+
+
+def render_label(info, granularity):
+    """按粒度 (LABELS 的键) 把 GeoInfo 渲染成标签"""
+    return LABELS[granularity](info or UNKNOWN)
+
+
+def _encode(info):
+    return '\x1f'.join(info)
+
+
+def _decode(value):
+    fields = value.split('\x1f') if value else []
+    return GeoInfo(*fields) if len(fields) == len(GeoInfo._fields) else UNKNOWN
+
+
+def _asn(text):
+    """'AS13335 Cloudflare, Inc.' -> 'AS13335'"""
+    head = (text or '').split(' ', 1)[0]
+    return head if head.startswith('AS') else ''
+
+
+def from_ip_api(record):
+    """ip-api.com 记录 (单查或批量，lang=zh-CN) -> 编码后的 GeoInfo，没有国家时返回 None"""
+    if not record.get('countryCode'):
+        return None
+    return _encode(GeoInfo(record['countryCode'], '', '', _asn(record.get('as')), '',
+                           record.get('country', ''), record.get('city', '')))
+
+
+# 离线索引记录需要带哪个字段才能渲染该粒度；不在表里的粒度 (asn) 索引回答不了，要远程查询。
+# colo 由 colo_trace 探测覆盖，不要求索引提供
+_LOCAL_FIELDS = {'country': 'country', 'country_code': 'country', 'city': 'city', 'colo': 'country'}
+_required = ('country',)
+
+
+def use_labels(granularities):
+    """声明本次要输出的标签粒度：离线索引只要能渲染这些粒度就直接使用 (如 busi.txt 建的只有国家的索引)"""
+    global _required
+    _required = tuple({_LOCAL_FIELDS.get(g) for g in granularities} | {'country'})
+
+
+def local_info(ip):
+    """离线前缀索引 (geo_index) 有所需粒度的字段时直接使用 (可以只有国家)，否则返回 None 走远程查询"""
+    record = geo_index.lookup(ip)
+    if record and all(field and getattr(record, field) for field in _required):
+        return _encode(GeoInfo(record.country, '', record.city, '', record.colo))
+    return None
+
+
+def _get(provider, url):
+    with span(provider):
+        return session().get(url, timeout=5)
+
+
+def fallback(ip):
+    """ip-api.com 之外的备用链: ipinfo.io → ipinfo lite → ipgeolocation.io，每个服务商一次请求拿全部字段"""
+    try:
+        ipinfo_limit.wait()
+        resp = _get('geo.ipinfo', f'https://ipinfo.io/{ip}/json')
+        if not ipinfo_limit.update(resp) and resp.status_code == 200:
+            data = resp.json()
+            if data.get('country'):
+                count('geo.level.ipinfo')
+                return _encode(GeoInfo(data['country'], '', data.get('city', ''), _asn(data.get('org')), ''))
+        log(f"  ipinfo.io 失败: {resp.status_code}，尝试 ipinfo lite...")
+    except Exception as e:
+        log(f"  ipinfo.io 异常 {ip}: {e}，尝试 ipinfo lite...")
+
+    try:
+        ipinfo_limit.wait()
+        resp = _get('geo.ipinfo.lite', f'https://api.ipinfo.io/lite/{ip}?token={IPINFO_TOKEN}')
+        if not ipinfo_limit.update(resp) and resp.status_code == 200:
+            data = resp.json()
+            if data.get('country_code'):
+                count('geo.level.ipinfo_lite')
+                return _encode(GeoInfo(data['country_code'], data.get('country', ''), '', data.get('asn', ''), ''))
+        log(f"  ipinfo lite 失败: {resp.status_code}，尝试 ipgeolocation.io...")
+    except Exception as e:
+        log(f"  ipinfo lite 异常 {ip}: {e}，尝试 ipgeolocation.io...")
+
+    try:
+        resp = _get('geo.ipgeolocation', f'https://api.ipgeolocation.io/ipgeo?apiKey=demo&ip={ip}')
+        if resp.status_code == 200:
+            data = resp.json()
+            if data.get('country_code2'):
+                count('geo.level.ipgeolocation')
+                return _encode(GeoInfo(data['country_code2'], data.get('country_name', ''), data.get('city', ''), '', ''))
+        log(f"  ipgeolocation.io 失败: {resp.status_code}")
+    except Exception as e:
+        log(f"  ipgeolocation.io 异常 {ip}: {e}")
+    count('geo.level.failed')
+    return ''
+
+
+@cached(GEO_KIND, failures=('',), local=local_info)
+def _lookup(ip):
+    """主: ip-api.com 单次查询 (中文，一次拿到国家/城市/ASN)；失败走备用链"""
+    try:
+        resp = _get('geo.ip-api.json', f'http://ip-api.com/json/{ip}?fields={IP_API_FIELDS}&lang={IP_API_LANG}')
+        data = resp.json()
+        if data.get('status') == 'success':
+            value = from_ip_api(data)
+            if value:
+                count('geo.level.ip-api')
+                return value
+        log(f"  ip-api.com 失败: {data.get('message', 'Unknown')}，尝试备用...")
+    except Exception as e:
+        log(f"  ip-api.com 查询失败 {ip}: {e}，尝试备用...")
+    return fallback(ip)
+
+
+def resolve(ip):
+    """IP -> GeoInfo (先查离线索引和缓存)；查不到返回 UNKNOWN"""
+    return _decode(_lookup(ip))
+
+
+def prefetch_all(ips, concurrency=FALLBACK_CONCURRENCY):
+    """批量解析一组 IP 写入缓存 (ip-api.com 批量接口 + 备用链)，之后 resolve 直接命中"""
+    prefetch(ips, GEO_KIND, from_ip_api, fallback, lang=IP_API_LANG, failures=('',), fields=IP_API_FIELDS,
+             concurrency=concurrency, local=local_info)
@@ -0,0 +1,267 @@
+import re
+import sys
+import heapq
+import base64
+import ipaddress
+from array import array
+from itertools import groupby
+
+# 候选片段: 只由十六进制数字、'.'、':' 和方括号组成的连续字符，单个字符类没有回溯
+_TOKEN = re.compile(r'[0-9A-Fa-f.:\[\]]{3,}')
+_TOKEN_CHARS = frozenset('0123456789abcdefABCDEF.:[]')
+_HEX = frozenset('0123456789abcdefABCDEF')
+MAX_CARRY = 128  # 流式解析时跨块保留的最长未完成片段
+COMPACT_EVERY = 65536  # AddressSet 攒够这么多新地址就排序并入已去重部分
+IPV6_BYTES = 16
+
+
+def parse_ipv4(s):
+    """点分十进制 -> 整数；不合法返回 None (不抛异常，和 ipaddress 一样拒绝前导零)"""
+    parts = s.split('.')
+    if len(parts) != 4:
+        return None
+    value = 0
+    for part in parts:
+        if not part.isdigit() or len(part) > 3 or (len(part) > 1 and part[0] == '0'):
+            return None
+        n = int(part)
+        if n > 255:
+            return None
+        value = (value << 8) | n
+    return value
+
+
+def _parse_groups(groups):
+    """解析 ':' 分隔的十六进制组，最后一组可以是内嵌 IPv4；返回 16 位值列表，不合法返回 None"""
+    values = []
+    for i, group in enumerate(groups):
+        if '.' in group and i == len(groups) - 1:
+            v4 = parse_ipv4(group)
+            if v4 is None:
+                return None
+            values.extend((v4 >> 16, v4 & 0xFFFF))
+        elif 1 <= len(group) <= 4 and all(c in _HEX for c in group):
+            values.append(int(group, 16))
+        else:
+            return None
+    return values
+
+
+def parse_ipv6(s):
+    """IPv6 文本 (支持 :: 压缩和内嵌 IPv4) -> 整数；不合法返回 None"""
+    if s.count('::') > 1:
+        return None
+    if '::' in s:
+        head, tail = s.split('::')
+        left = _parse_groups(head.split(':')) if head else []
+        right = _parse_groups(tail.split(':')) if tail else []
+        if left is None or right is None or len(left) + len(right) > 7:
+            return None
+        values = left + [0] * (8 - len(left) - len(right)) + right
+    else:
+        values = _parse_groups(s.split(':'))
+        if values is None or len(values) != 8:
+            return None
+    result = 0
+    for v in values:
+        result = (result << 16) | v
+    return result
+
+
+def format_ipv4(value):
+    return f'{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}'
+
+
+def format_ipv6(value):
+    """整数 -> 压缩形式的小写 IPv6 文本"""
+    return ipaddress.IPv6Address(value).compressed
+
+
+def _parse_port(s):
+    if s.isdigit() and len(s) <= 5 and 0 < int(s) < 65536:
+        return int(s)
+    return None
+
+
+def _labelled_ipv4(token):
+    """'IP:1.2.3.4'、'IPv4:1.2.3.4:443' 这类带前缀标签的片段：取第一个合法的点分四段及其后的端口"""
+    parts = token.split(':')
+    for i, part in enumerate(parts):
+        if '.' in part:
+            value = parse_ipv4(part)
+            if value is not None:
+                return 4, value, _parse_port(parts[i + 1]) if i + 1 < len(parts) else None
+    return None
+
+
+def classify(token):
+    """把一个候选片段解析成 (4 或 6, 地址整数, 端口或 None)；不是地址返回 None"""
+    token = token.strip('.')
+    if token.endswith(':') and not token.endswith('::'):
+        token = token[:-1]  # 句末或 'IP:' 这类尾随冒号
+    if token.startswith('['):
+        end = token.find(']')
+        if end < 0:
+            return None
+        value = parse_ipv6(token[1:end])
+        if value is None:
+            return None
+        rest = token[end + 1:]
+        port = _parse_port(rest[1:]) if rest.startswith(':') else None
+        return 6, value, port
+    token = token.strip('[]')
+    colons = token.count(':')
+    if colons <= 1 and '.' in token:
+        host, _, port = token.partition(':')
+        value = parse_ipv4(host)
+        if value is None:
+            return _labelled_ipv4(token)
+        return 4, value, _parse_port(port) if port else None
+    if colons >= 2:
+        value = parse_ipv6(token)
+        # 排除 '::' 全零地址和不含数字的片段 (多半是代码或 CSS 的 a::before 之类)
+        if value and any(c.isdigit() for c in token):
+            return 6, value, None
+        if '.' in token:
+            return _labelled_ipv4(token)
+    return None
+
+
+class AddressSet:
+    """地址整数的紧凑有序集合：IPv4 用 array('I') (每个地址 4 字节)，IPv6 用 128 位整数列表
+
+    新地址先追加到待处理区，攒够 COMPACT_EVERY 个 (或读取时) 才排序、与已去重部分归并并去重，
+    迭代按数值升序，不为每个地址建字符串或集合条目。
+    """
+
+    def __init__(self, typecode=None, values=()):
+        self.typecode = typecode
+        self._values = self._new()  # 已排序去重
+        self._pending = self._new()
+        self.update(values)
+
+    def _new(self, values=()):
+        return array(self.typecode, values) if self.typecode else list(values)
+
+    def add(self, value):
+        self._pending.append(value)
+        if len(self._pending) >= COMPACT_EVERY:
+            self._compact()
+
+    def update(self, values):
+        if isinstance(values, AddressSet) and values.typecode == self.typecode:
+            values._compact()
+            self._pending.extend(values._values)  # 同类型直接整段拷贝
+            if len(self._pending) >= COMPACT_EVERY:
+                self._compact()
+            return
+        for value in values:
+            self.add(value)
+
+    def pack(self):
+        """紧凑的文本形式 (base64)：IPv4 为小端 uint32 数组，IPv6 为每个 16 字节大端；用 unpack_ipv4/unpack_ipv6 还原"""
+        self._compact()
+        if self.typecode:
+            values = array(self.typecode, self._values)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            data = values.tobytes()
+        else:
+            data = b''.join(value.to_bytes(IPV6_BYTES, 'big') for value in self._values)
+        return base64.b64encode(data).decode('ascii')
+
+    def _compact(self):
+        if self._pending:
+            merged = heapq.merge(self._values, sorted(self._pending))
+            self._values = self._new(value for value, _ in groupby(merged))
+            self._pending = self._new()
+
+    def __len__(self):
+        self._compact()
+        return len(self._values)
+
+    def __iter__(self):
+        self._compact()
+        return iter(self._values)
+
+    def __eq__(self, other):
+        if not isinstance(other, AddressSet):
+            return NotImplemented
+        self._compact()
+        other._compact()
+        return list(self._values) == list(other._values)
+
+
+def ipv4_set(values=()):
+    return AddressSet('I', values)
+
+
+def ipv6_set(values=()):
+    return AddressSet(None, values)
+
+
+def unpack_ipv4(text):
+    """AddressSet.pack 的逆操作 (IPv4)"""
+    result = ipv4_set()
+    result._values.frombytes(base64.b64decode(text))
+    if sys.byteorder == 'big':
+        result._values.byteswap()
+    return result
+
+
+def unpack_ipv6(text):
+    """AddressSet.pack 的逆操作 (IPv6)"""
+    data = base64.b64decode(text)
+    result = ipv6_set()
+    result._values = [int.from_bytes(data[i:i + IPV6_BYTES], 'big') for i in range(0, len(data), IPV6_BYTES)]
+    return result
+
+
+class IPExtractor:
+    """单遍提取 IPv4 / IPv6 / IP:端口 / [v6]:端口，可分块喂入文本
+
+    ipv4 / ipv6 为地址整数的 AddressSet (按数值升序)，endpoints 为带端口的 (4 或 6, 地址整数, 端口) 集合。
+    """
+
+    def __init__(self):
+        self.ipv4 = ipv4_set()
+        self.ipv6 = ipv6_set()
+        self.endpoints = set()
+        self.candidates = 0
+        self._carry = ''
+
+    def feed(self, chunk):
+        """处理一块文本；块尾可能被截断的片段留到下一块再解析"""
+        text = self._carry + chunk
+        cut = len(text)
+        while cut > 0 and text[cut - 1] in _TOKEN_CHARS and len(text) - cut < MAX_CARRY:
+            cut -= 1
+        self._carry = text[cut:]
+        self._scan(text[:cut])
+
+    def close(self):
+        """处理剩余的未完成片段"""
+        self._scan(self._carry)
+        self._carry = ''
+        return self
+
+    def _scan(self, text):
+        for match in _TOKEN.finditer(text):
+            token = match.group()
+            if ':' not in token and '.' not in token:
+                continue
+            self.candidates += 1
+            parsed = classify(token)
+            if parsed is None:
+                continue
+            version, value, port = parsed
+            (self.ipv4 if version == 4 else self.ipv6).add(value)
+            if port is not None:
+                self.endpoints.add(parsed)
+
+
+def extract(text):
+    """一次性提取整段文本，返回 IPExtractor"""
+    extractor = IPExtractor()
+    extractor.feed(text)
+    return extractor.close()
@@ -0,0 +1,185 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+
+RESULTS_DB_PATH = os.environ.get('RESULTS_DB_PATH', 'results.db')
+EWMA_ALPHA = float(os.environ.get('RESULTS_EWMA_ALPHA', '0.3'))  # 新样本权重
+PERCENTILE_WINDOW = 50  # p50/p90 取每个 IP 最近多少次成功测量
+
+# 增量模式: 只测新 IP、过期 IP 和延迟明显变化的 IP，其余沿用历史得分
+INCREMENTAL = os.environ.get('SPEED_INCREMENTAL', '0') == '1'
+STALE_AGE = float(os.environ.get('SPEED_STALE_AGE', str(6 * 3600)))  # 成功结果超过这么久 (秒) 就重测
+RTT_CHANGE = float(os.environ.get('SPEED_RTT_CHANGE', '0.3'))  # 延迟相对变化超过 30% 视为路由变了
+RTT_CHANGE_MIN = 20.0  # 且绝对变化至少 20ms
+BACKOFF_BASE = 3600.0  # 连续失败的 IP 第 1 次失败后跳过 1 小时，之后每次翻倍
+BACKOFF_MAX = 7 * 86400.0
+
+# 单个 IP 的滚动统计；ewma 只对成功样本平滑，fail_rate 为失败的 EWMA，score = ewma * (1 - fail_rate)
+# fail_streak 为连续失败次数，last_success / last_rtt 为最近一次成功时间和最近一次延迟
+IPStats = namedtuple('IPStats', 'ip port location ewma fail_rate samples p50 p90 last_seen score '
+                                'fail_streak last_success last_rtt')
+_STATS_COLUMNS = 'ip, port, location, ewma, fail_rate, samples, last_seen, fail_streak, last_success, last_rtt'
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class ResultsStore:
+    """追加写入的测速历史 (SQLite)：measurements 记录每次测量，ip_stats 增量维护每个 IP 的滚动统计
+
+    measurements 按 (ip, ts) 和 ts 建索引，查询某 IP 最近 N 次或某时间段都走索引，
+    几个月的每小时记录也不需要全表扫描。
+    """
+
+    def __init__(self, path=RESULTS_DB_PATH, alpha=EWMA_ALPHA):
+        self.path = path
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        # 分片测速时多个进程共用一个库，写锁等待放宽到 30 秒
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS measurements (
+                ts REAL NOT NULL, ip TEXT NOT NULL, port TEXT, rtt REAL, mbps REAL,
+                location TEXT, success INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS idx_measurements_ip_ts ON measurements (ip, ts);
+            CREATE INDEX IF NOT EXISTS idx_measurements_ts ON measurements (ts);
+            CREATE TABLE IF NOT EXISTS ip_stats (
+                ip TEXT PRIMARY KEY, port TEXT, location TEXT, ewma REAL NOT NULL, fail_rate REAL NOT NULL,
+                samples INTEGER NOT NULL, last_seen REAL NOT NULL, fail_streak INTEGER NOT NULL DEFAULT 0,
+                last_success REAL NOT NULL DEFAULT 0, last_rtt REAL NOT NULL DEFAULT 0);
+        ''')
+        # 旧库补上增量模式需要的列
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(ip_stats)')}
+        for column in ('fail_streak INTEGER', 'last_success REAL', 'last_rtt REAL'):
+            if column.split()[0] not in columns:
+                try:
+                    self.conn.execute(f'ALTER TABLE ip_stats ADD COLUMN {column} NOT NULL DEFAULT 0')
+                except sqlite3.OperationalError as e:
+                    if 'duplicate column' not in str(e):  # 另一个分片进程刚加上
+                        raise
+        self.conn.commit()
+
+    def record(self, ip, port, rtt, mbps, location, success, ts=None):
+        """追加一次测量并更新该 IP 的滚动统计，返回新的 IPStats"""
+        with self.lock:
+            values = self._record(ip, port, rtt, mbps, location, success, ts or time.time())
+            self.conn.commit()
+            return self._stats(*values)
+
+    def record_unreachable(self, tasks, ts=None):
+        """延迟预筛连不上的 [(ip, port), ...] 各记一次失败 (一个事务)，让退避也覆盖不通的 IP"""
+        ts = ts or time.time()
+        with self.lock:
+            for ip, port in tasks:
+                self._record(ip, port, None, 0.0, None, False, ts)
+            self.conn.commit()
+
+    def _record(self, ip, port, rtt, mbps, location, success, ts):
+        """写一条测量并更新 ip_stats (调用方持锁并提交)；location 为 None 时沿用上次的归属地"""
+        self.conn.execute('INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (ts, ip, port, rtt, mbps, location, int(success)))
+        row = self.conn.execute('SELECT ewma, fail_rate, samples, fail_streak, last_success, location, last_rtt '
+                                'FROM ip_stats WHERE ip = ?', (ip,)).fetchone()
+        failed = 0.0 if success else 1.0
+        if row is None:
+            ewma, fail_rate, samples, fail_streak, last_success = (mbps if success else 0.0), failed, 1, 0, 0.0
+            last_rtt = 0.0
+        else:
+            ewma, fail_rate, samples, fail_streak, last_success, last_location, last_rtt = row
+            if success:
+                ewma = mbps if ewma == 0 else ewma + self.alpha * (mbps - ewma)
+            fail_rate += self.alpha * (failed - fail_rate)
+            samples += 1
+            location = last_location if location is None else location
+        if success:
+            fail_streak, last_success = 0, ts
+        else:
+            fail_streak += 1
+        values = (ip, port, location, ewma, fail_rate, samples, ts, fail_streak, last_success, rtt or last_rtt)
+        self.conn.execute(f'INSERT OR REPLACE INTO ip_stats ({_STATS_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          values)
+        return values
+
+    def _stats(self, ip, port, location, ewma, fail_rate, samples, last_seen, fail_streak, last_success, last_rtt):
+        speeds = sorted(r[0] for r in self.conn.execute(
+            'SELECT mbps FROM measurements WHERE ip = ? AND success = 1 ORDER BY ts DESC LIMIT ?',
+            (ip, PERCENTILE_WINDOW)))
+        return IPStats(ip, port, location, ewma, fail_rate, samples,
+                       _percentile(speeds, 0.5), _percentile(speeds, 0.9), last_seen, ewma * (1 - fail_rate),
+                       fail_streak, last_success, last_rtt)
+
+    def stats(self, ip):
+        """某 IP 的当前统计，没有记录返回 None"""
+        with self.lock:
+            row = self.conn.execute(f'SELECT {_STATS_COLUMNS} FROM ip_stats WHERE ip = ?', (ip,)).fetchone()
+            return self._stats(*row) if row else None
+
+    def top(self, n=50, since=None):
+        """按平滑得分取前 n 个 IP；since 限定最近有测量的 IP (time.time() 秒)"""
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {_STATS_COLUMNS} FROM ip_stats '
+                                     'WHERE last_seen >= ? ORDER BY ewma * (1 - fail_rate) DESC LIMIT ?',
+                                     (since or 0, n)).fetchall()
+            return [self._stats(*row) for row in rows]
+
+    def history(self, ip, since=None):
+        """某 IP 的测量记录 [(ts, mbps, rtt, success), ...]，按时间升序"""
+        with self.lock:
+            return self.conn.execute('SELECT ts, mbps, rtt, success FROM measurements WHERE ip = ? AND ts >= ? '
+                                     'ORDER BY ts', (ip, since or 0)).fetchall()
+
+    def measurements(self, since=None):
+        """since 之后的全部测量 [(ts, ip, mbps, success), ...]，按时间升序"""
+        with self.lock:
+            return self.conn.execute('SELECT ts, ip, mbps, success FROM measurements WHERE ts > ? ORDER BY ts',
+                                     (since or 0,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def backoff_filter(store, tasks, now=None):
+    """增量模式第一步: 去掉仍在退避期内的连续失败 IP，返回 (要继续处理的 tasks, 跳过数)"""
+    now = now or time.time()
+    kept = []
+    for task in tasks:
+        stats = store.stats(task[0])
+        if stats and stats.fail_streak:
+            wait = min(BACKOFF_BASE * 2 ** (stats.fail_streak - 1), BACKOFF_MAX)
+            if now - stats.last_seen < wait:
+                continue
+        kept.append(task)
+    return kept, len(tasks) - len(kept)
+
+
+def incremental_split(store, tasks, rtts, now=None):
+    """增量模式第二步 (在延迟预筛之后): 分出需要重测的 tasks 和可以沿用历史结果的 IPStats
+
+    重测: 没有历史、最近一次测量失败、成功结果已超过 STALE_AGE、或这次探测的延迟相对上次变化明显。
+    """
+    now = now or time.time()
+    retest, reuse = [], []
+    for task in tasks:
+        ip = task[0]
+        stats = store.stats(ip)
+        if (stats is None or stats.fail_streak or not stats.last_success
+                or now - stats.last_success > STALE_AGE):
+            retest.append(task)
+            continue
+        rtt = rtts.get(ip)
+        if rtt is not None and stats.last_rtt:
+            change = abs(rtt - stats.last_rtt)
+            if change > RTT_CHANGE_MIN and change > RTT_CHANGE * stats.last_rtt:
+                retest.append(task)
+                continue
+        reuse.append(stats)
+    return retest, reuse
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import contextlib
+from collections import Counter
+
+# 运行报告: 各阶段耗时直方图 + 计数器，结束时写 JSON 并打印简要汇总 (开销只是内存里的累加，每小时运行都开着)
+RUN_REPORT_PATH = os.environ.get('RUN_REPORT_PATH', 'run_report.json')
+RUN_EVENTS_PATH = os.environ.get('RUN_EVENTS_PATH', '')  # 非空时每个 span 另写一行 NDJSON，排查单次运行用
+VERBOSE = os.environ.get('RUN_VERBOSE', '0') == '1'  # 逐次尝试/逐个备用 API 的过程日志，默认不打印
+
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)  # 直方图上界 (毫秒)
+
+
+def log(message):
+    """过程日志，只在 RUN_VERBOSE=1 时打印"""
+    if VERBOSE:
+        print(message)
+
+
+class Histogram:
+    """固定对数分桶的耗时直方图 (毫秒)"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.n += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        """按分桶估计的分位数 (取所在桶的上界，不超过最大值)"""
+        target = q * self.n
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'n': self.n, 'total_ms': round(self.total, 1), 'max_ms': round(self.max, 1),
+                'p50_ms': self.percentile(0.5), 'p90_ms': self.percentile(0.9),
+                'buckets': {(f'<={b}' if i < len(BUCKETS_MS) else f'>{BUCKETS_MS[-1]}'): c
+                            for i, (b, c) in enumerate(zip(BUCKETS_MS + (None,), self.buckets)) if c}}
+
+
+class RunReport:
+    """进程内共享：span()/observe() 记录阶段耗时，count() 记录重试、缓存命中、按原因分类的失败等"""
+
+    def __init__(self, events_path=RUN_EVENTS_PATH):
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.events = open(events_path, 'a', encoding='utf-8') if events_path else None
+
+    def observe(self, name, seconds, **fields):
+        """记录一次耗时 (秒)"""
+        ms = seconds * 1000
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(ms)
+            if self.events:
+                self.events.write(json.dumps({'ts': round(time.time(), 3), 'span': name, 'ms': round(ms, 1), **fields},
+                                             ensure_ascii=False) + '\n')
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        """计时上下文；块内抛出异常时同时计数 {name}.error"""
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.count(f'{name}.error')
+            raise
+        finally:
+            self.observe(name, time.monotonic() - start, **fields)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def to_dict(self, script=None):
+        with self.lock:
+            return {
+                'script': script,
+                'started': self.started,
+                'elapsed_s': round(time.time() - self.started, 2),
+                'phases': {name: h.to_dict() for name, h in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def summary(self):
+        """简要汇总：每个阶段一行 次数/p50/p90/累计，计数器合并成一行"""
+        lines = [f'运行汇总 (用时 {time.time() - self.started:.1f}s):']
+        with self.lock:
+            for name, h in sorted(self.histograms.items()):
+                lines.append(f'  {name:<24} n={h.n:<5} p50={h.percentile(0.5):>6.0f}ms p90={h.percentile(0.9):>6.0f}ms '
+                             f'累计={h.total / 1000:.1f}s')
+            if self.counters:
+                lines.append('  ' + ', '.join(f'{k}={v}' for k, v in sorted(self.counters.items())))
+        return '\n'.join(lines)
+
+    def finish(self, script=None, path=RUN_REPORT_PATH):
+        """写 JSON 报告并打印汇总"""
+        data = self.to_dict(script)
+        if path:
+            tmp = f'{path}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, path)
+        if self.events:
+            self.events.flush()
+        print(self.summary())
+        return data
+
+
+report = RunReport()
+span = report.span
+observe = report.observe
+count = report.count
+
+
+def finish(script=None, path=RUN_REPORT_PATH):
+    return report.finish(script or os.path.basename(sys.argv[0]), path)
@@ -0,0 +1,81 @@
+import re
+import time
+import json
+import requests
+from urllib.parse import urljoin
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+SELENIUM_WAIT = 10  # 等待页面 JS 加载的秒数
+
+# 页面脚本里引用的数据接口，如 fetch('/api/ips') 或 "data/ip.json"
+_SCRIPT = re.compile(r'<script[^>]*>(.*?)</script>', re.S | re.I)
+_DATA_URL = re.compile(r'''(?:fetch|get|ajax|url)\s*\(?\s*:?\s*['"]([^'"]+)['"]|['"]([^'"\s]+\.(?:json|txt|csv))['"]''', re.I)
+MAX_DATA_URLS = 5
+
+
+def render_selenium(url):
+    """无头 Chrome 渲染后返回页面源码；selenium 只在真正用到时才导入"""
+    try:
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+        from selenium.webdriver.chrome.options import Options
+        from webdriver_manager.chrome import ChromeDriverManager
+    except ImportError as e:
+        raise RuntimeError(f'selenium backend needs `pip install selenium webdriver-manager`: {e}')
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")  # 无头模式,适合Actions
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    service = Service(ChromeDriverManager().install())
+    driver = webdriver.Chrome(service=service, options=chrome_options)
+    try:
+        driver.get(url)
+        time.sleep(SELENIUM_WAIT)  # 等待JS加载IP
+        return driver.page_source
+    finally:
+        driver.quit()
+
+
+def render_jsdata(url, timeout=7):
+    """不启动浏览器：取页面 HTML，再把内联脚本里引用的数据接口 (JSON/文本) 一并取回拼在后面
+
+    适合 IP 列表由脚本从接口拉取或直接写在脚本变量里的页面。
+    """
+    headers = {'User-Agent': USER_AGENT}
+    resp = requests.get(url, headers=headers, timeout=timeout)
+    resp.raise_for_status()
+    parts = [resp.text]
+    data_urls = []
+    for script in _SCRIPT.findall(resp.text):
+        for match in _DATA_URL.finditer(script):
+            target = match.group(1) or match.group(2)
+            if target and not target.startswith(('javascript:', '#')):
+                data_urls.append(urljoin(url, target))
+    for data_url in list(dict.fromkeys(data_urls))[:MAX_DATA_URLS]:
+        try:
+            data_resp = requests.get(data_url, headers=headers, timeout=timeout)
+        except Exception as e:
+            print(f'{url}: data url {data_url} failed: {e}')
+            continue
+        if data_resp.status_code != 200:
+            continue
+        try:
+            # JSON 重新序列化一次，去掉转义，方便后续提取
+            parts.append(json.dumps(data_resp.json(), ensure_ascii=False))
+        except ValueError:
+            parts.append(data_resp.text)
+    return '\n'.join(parts)
+
+
+BACKENDS = {
+    'selenium': render_selenium,
+    'jsdata': render_jsdata,
+}
+
+
+def render(url, backend):
+    """按后端名取回动态页面内容"""
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown source backend: {backend}')
+    print(f'Using {backend} backend for dynamic site: {url}')
+    return BACKENDS[backend](url)
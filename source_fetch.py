@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import codecs
+import requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from run_report import observe, count, log
+
+SOURCE_STATE_PATH = os.environ.get('SOURCE_STATE_PATH', 'source_state.json')
+FETCH_CONCURRENCY = 8
+FETCH_TIMEOUT = 7
+STREAM_CHUNK = 64 * 1024  # 流式解析时每次读取的字节数
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# 单个源的抓取结果；status 为 HTTP 状态码 (异常时为 0)，not_modified 表示 304 可直接用上次提取的 IP
+# parsed 为流式解析的结果 (fetch_sources 给了 sink 时)，此时 text 为 None
+FetchResult = namedtuple('FetchResult', 'url status text elapsed bytes not_modified error parsed', defaults=(None,))
+
+
+class SourceState:
+    """每个源的 ETag/Last-Modified、上次提取出的 IP 和最近一次抓取统计，存为 JSON"""
+
+    def __init__(self, path=SOURCE_STATE_PATH):
+        self.path = path
+        self.sources = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.sources = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f'Failed to load {path}: {e}')
+
+    def get(self, url):
+        return self.sources.setdefault(url, {})
+
+    def conditional_headers(self, url):
+        entry = self.sources.get(url, {})
+        headers = {}
+        # 只有上次确实提取到过 IP 才发条件请求，否则 304 时没有可用的旧结果
+        if 'ipv4' in entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def save(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.sources, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+def _session(concurrency):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def _stream(resp, parser):
+    """按块解码响应并喂给 parser，不在内存里保留整个响应；返回 (parser.close(), 字节数)"""
+    decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+    size = 0
+    for chunk in resp.iter_content(STREAM_CHUNK):
+        size += len(chunk)
+        parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b'', final=True))
+    return parser.close(), size
+
+
+def fetch_sources(urls, state, concurrency=FETCH_CONCURRENCY, timeout=FETCH_TIMEOUT, sink=None):
+    """用共享连接池并发抓取全部源，带上次的 ETag/Last-Modified 做条件请求
+
+    sink(url) -> 有 feed(文本块)/close() 的解析器 (如 ip_extract.IPExtractor)：给出时 200 响应边下载边解析，
+    FetchResult.parsed 为 close() 的返回值；不给时整个响应读进 FetchResult.text
+    返回 {url: FetchResult}；同时把新的校验头和抓取统计写回 state (调用方负责 save)
+    """
+    session = _session(concurrency)
+
+    def fetch(url):
+        headers = {'Cache-Control': 'no-cache'}  # 让中间缓存向源站重新验证，而不是直接丢弃校验头
+        headers.update(state.conditional_headers(url))
+        start = time.monotonic()
+        try:
+            with session.get(url, headers=headers, timeout=timeout, stream=sink is not None) as resp:
+                if resp.status_code == 304:
+                    return FetchResult(url, 304, None, time.monotonic() - start, 0, True, '')
+                if resp.status_code == 200 and sink is not None:
+                    parsed, size = _stream(resp, sink(url))
+                    result = FetchResult(url, 200, None, time.monotonic() - start, size, False, '', parsed)
+                else:
+                    text = resp.text if resp.status_code == 200 else None
+                    result = FetchResult(url, resp.status_code, text, time.monotonic() - start, len(resp.content),
+                                         False, '')
+        except Exception as e:
+            return FetchResult(url, 0, None, time.monotonic() - start, 0, False, str(e))
+        if resp.status_code == 200:
+            entry = state.get(url)
+            entry['etag'] = resp.headers.get('ETag')
+            entry['last_modified'] = resp.headers.get('Last-Modified')
+        return result
+
+    with session, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = {r.url: r for r in pool.map(fetch, urls)}
+    for r in results.values():
+        state.get(r.url)['last_fetch'] = {'status': r.status, 'elapsed': round(r.elapsed, 3), 'bytes': r.bytes,
+                                          'time': int(time.time())}
+        observe('source.fetch', r.elapsed, url=r.url, status=r.status)
+        count(f'source.status.{r.status or "error"}')
+        log(f'{r.url}: status {r.status or r.error}, {r.bytes} bytes, {r.elapsed * 1000:.0f}ms'
+            f'{" (not modified)" if r.not_modified else ""}')
+    statuses = [r.status for r in results.values()]
+    print(f'抓取 {len(results)} 个源: 200 {statuses.count(200)} 个, 304 {statuses.count(304)} 个, '
+          f'失败 {len(statuses) - statuses.count(200) - statuses.count(304)} 个, '
+          f'共 {sum(r.bytes for r in results.values())} 字节')
+    return results
@@ -0,0 +1,140 @@
+import os
+import re
+import time
+import heapq
+import tempfile
+import threading
+from collections import namedtuple
+
+TOP_N = 50
+OUTPUT_PATH = 'speed_ip.txt'
+FAMILY_PATHS = {4: 'speed_ipv4.txt', 6: 'speed_ipv6.txt'}  # 分地址族的榜单
+
+# 单个 IP 的测速结果；speed 为 MB/s，latency 为第一阶段建连延迟 (毫秒)，timestamp 为 time.time()
+# aggregate 为 streams 条连接同时下载的聚合 MB/s (没测多连接时为 0)
+SpeedRecord = namedtuple('SpeedRecord', 'ip port location speed latency timestamp aggregate streams',
+                         defaults=(0.0, 0))
+
+
+def format_record(record):
+    """格式: IP:端口#归属地 速率 延迟 [连接数x聚合速率]，IPv6 写成 [IP]:端口"""
+    host = f'[{record.ip}]' if ip_family(record.ip) == 6 else record.ip
+    line = f"{host}:{record.port}#{record.location} {record.speed}MB/s {record.latency:.0f}ms"
+    if record.streams > 1:
+        line += f" {record.streams}x{record.aggregate}MB/s"
+    return line
+
+
+def ip_family(ip):
+    return 6 if ':' in ip else 4
+
+
+_RECORD_LINE = re.compile(r'^(\S+):(\d+)#(.*?) ([\d.]+)MB/s(?: ([\d.]+)ms)?(?: (\d+)x([\d.]+)MB/s)?\s*$')
+
+
+def parse_record(line, timestamp=0.0):
+    """format_record 的逆操作 (也兼容没有延迟字段的旧格式)；无法解析返回 None"""
+    match = _RECORD_LINE.match(line.strip())
+    if not match:
+        return None
+    ip, port, location, speed, latency, streams, aggregate = match.groups()
+    return SpeedRecord(ip.strip('[]'), port, location, float(speed), float(latency or 0), timestamp,
+                       float(aggregate or 0), int(streams or 0))
+
+
+def read_records(path):
+    """读取 speed_ip.txt 这类结果文件，文件不存在时返回空列表"""
+    if not os.path.exists(path):
+        return []
+    mtime = os.path.getmtime(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        return [r for r in (parse_record(line, mtime) for line in f) if r]
+
+
+def write_atomic(path, lines):
+    """先写同目录临时文件再 rename，任何时刻 path 都是完整文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line + '\n')
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class TopN:
+    """用容量为 n 的最小堆保存目前最快的 n 个结果，名单变化时原子地重写输出文件
+
+    测速中途崩溃或 Actions 超时被杀，输出文件里也总是到那一刻为止的前 n 名。
+    """
+
+    def __init__(self, n=TOP_N, path=OUTPUT_PATH):
+        self.n = n
+        self.path = path
+        self.heap = []  # (speed, seq, record)，堆顶是榜上最慢的
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        """加入一个结果；进入前 n 名时刷新输出文件并返回 True"""
+        with self.lock:
+            self.seq += 1
+            item = (record.speed, self.seq, record)
+            if len(self.heap) < self.n:
+                heapq.heappush(self.heap, item)
+            elif record.speed > self.heap[0][0]:
+                heapq.heapreplace(self.heap, item)
+            else:
+                return False
+            self._flush()
+            return True
+
+    def cutoff(self):
+        """入榜最低速率；榜未满时为 0 (不设门槛)"""
+        with self.lock:
+            return self.heap[0][0] if len(self.heap) >= self.n else 0
+
+    def records(self):
+        """按速率降序返回榜上结果"""
+        with self.lock:
+            return [item[2] for item in sorted(self.heap, reverse=True)]
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.path:
+            write_atomic(self.path, [format_record(item[2]) for item in sorted(self.heap, reverse=True)])
+
+
+class Rankings:
+    """合并榜 + 每个地址族各自的榜 (各 n 个)，结果同时尝试进入合并榜和所属地址族的榜"""
+
+    def __init__(self, n=TOP_N, path=OUTPUT_PATH, family_paths=FAMILY_PATHS):
+        self.combined = TopN(n, path)
+        self.families = {family: TopN(n, family_path) for family, family_path in family_paths.items()}
+
+    def add(self, record):
+        """进入任一榜单时返回 True"""
+        added = self.combined.add(record)
+        return self.families[ip_family(record.ip)].add(record) or added
+
+    def cutoff(self, ip):
+        """ip 入榜的最低速率：所属地址族的榜 (包含合并榜里该族的全部结果) 门槛更低，以它为准"""
+        return self.families[ip_family(ip)].cutoff()
+
+    def records(self):
+        return self.combined.records()
+
+    def flush(self):
+        self.combined.flush()
+        for top in self.families.values():
+            top.flush()
+
+
+def make_record(ip, port, location, speed, latency, aggregate=0.0, streams=0):
+    return SpeedRecord(ip, port, location, speed, latency, time.time(), aggregate, streams)
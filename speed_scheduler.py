@@ -0,0 +1,153 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from downloader import probe_latency, Measurement
+from run_report import count, log
+
+# 并发测速调度配置 (均可用环境变量覆盖，方便 Actions 调参)
+CONCURRENCY = int(os.environ.get('SPEED_CONCURRENCY', '4'))  # 同时进行的带宽测试数
+GEO_CONCURRENCY = int(os.environ.get('GEO_CONCURRENCY', '8'))  # 同时进行的归属地查询数
+PER_IP_TIMEOUT = float(os.environ.get('SPEED_PER_IP_TIMEOUT', '40'))  # 单 IP 截止时间 (秒，含重试)
+TIME_BUDGET = float(os.environ.get('SPEED_TIME_BUDGET', '1500'))  # 全局时间预算 (秒)，避免撞上下一次 cron
+BANDWIDTH_CAP = float(os.environ.get('SPEED_BANDWIDTH_CAP', '100'))  # 总并发带宽上限 (MB/s)，0 表示不限
+# 第一阶段延迟预筛 (TCP 建连 + TLS 握手)，只有通过的 IP 才做完整带宽测试
+PREFILTER_TOP_K = int(os.environ.get('SPEED_PREFILTER_TOP_K', '80'))  # 按延迟取前 K 个，0 表示不限
+PREFILTER_MAX_RTT = float(os.environ.get('SPEED_PREFILTER_MAX_RTT', '1000'))  # 建连延迟上限 (毫秒)，0 表示不限
+PREFILTER_CONCURRENCY = int(os.environ.get('SPEED_PREFILTER_CONCURRENCY', '32'))
+PREFILTER_TIMEOUT = float(os.environ.get('SPEED_PREFILTER_TIMEOUT', '3'))  # 单次探测超时 (秒)
+GATE_ALPHA = 0.3  # 闸门速率估计的 EWMA 平滑系数
+
+
+class BandwidthGate:
+    """总带宽闸门：每个下载按"近期单流速率的 EWMA"预占带宽，预占总和不超过上限。
+
+    不对单个下载限速 (那样会把测速结果削平)，而是限制同时跑的下载数，
+    让并发下载的速率之和不会顶满网卡而互相拖慢。至少允许一个下载进行。
+    估计值随测量上下浮动 (而不是只升不降)，个别极快的 IP 不会把后面的测试压成串行。
+    """
+
+    def __init__(self, cap_mbps, slots):
+        self.cap = cap_mbps
+        self.estimate = cap_mbps / max(slots, 1) if cap_mbps > 0 else 0
+        self.reserved = 0.0
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, deadline, streams=1):
+        """等待可用带宽 (streams 条连接各按估计值预占)；到 deadline 仍等不到返回 None，否则返回预占量"""
+        with self.cond:
+            while True:
+                want = self.estimate * streams
+                if self.cap <= 0 or self.active == 0 or self.reserved + want <= self.cap:
+                    self.reserved += want
+                    self.active += 1
+                    return want
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def release(self, reserved, measured_mbps):
+        """归还预占量；measured_mbps 为这次的单流速率 (失败为 0，不参与估计)"""
+        with self.cond:
+            self.reserved -= reserved
+            self.active -= 1
+            if measured_mbps > 0:
+                measured = min(measured_mbps, self.cap) if self.cap > 0 else measured_mbps
+                self.estimate += GATE_ALPHA * (measured - self.estimate)
+            self.cond.notify_all()
+
+
+def prefilter(tasks, top_k=None, max_rtt=None, concurrency=None, timeout=None):
+    """并发探测全部候选的 TCP/TLS 延迟 (探测各自写的端口)，丢掉不通的，按建连延迟排序后截取
+
+    返回 (保留的 [(ip, port), ...] 按延迟升序, {ip: 建连毫秒})
+    """
+    top_k = PREFILTER_TOP_K if top_k is None else top_k
+    max_rtt = PREFILTER_MAX_RTT if max_rtt is None else max_rtt
+    concurrency = concurrency or PREFILTER_CONCURRENCY
+    timeout = timeout or PREFILTER_TIMEOUT
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        probes = list(pool.map(lambda task: probe_latency(task[0], timeout=timeout, port=int(task[1])), tasks))
+    reachable = [(rtt[0], task) for task, rtt in zip(tasks, probes) if rtt is not None]
+    reachable.sort(key=lambda item: item[0])
+    kept = [(rtt, task) for rtt, task in reachable if not max_rtt or rtt <= max_rtt]
+    if top_k:
+        kept = kept[:top_k]
+    print(f"延迟预筛: {len(tasks)} 个候选，可连通 {len(reachable)}，进入带宽测试 {len(kept)} "
+          f"(前 {top_k or '全部'} 个, 上限 {max_rtt or '不限'}ms, 用时 {time.monotonic() - start:.1f}s)")
+    return [task for _, task in kept], {task[0]: rtt for rtt, task in reachable}
+
+
+def run_speed_tests(tasks, geo_fn, speed_fn, on_result=None,
+                    concurrency=None, geo_concurrency=None,
+                    per_ip_timeout=None, time_budget=None, bandwidth_cap=None, streams=1):
+    """并发跑 归属地查询 + 带宽测试
+
+    tasks: [(ip, port), ...]
+    geo_fn(ip) -> 归属地 (原样传给 on_result；查询抛异常时为 None)
+    speed_fn(ip, port, deadline) -> downloader.Measurement (deadline 为 time.monotonic() 绝对时间)
+    streams: speed_fn 最多同时开的连接数 (多连接聚合测试)，带宽闸门按这么多条连接预占
+    on_result(ip, port, label, measurement): 每个 IP 完成时回调 (在工作线程中调用，已加锁)，
+        port 为实际测速的端口 (多端口模式下是最快的那个)
+    返回 [(ip, port, label, measurement), ...]，按完成顺序；因全局预算用尽 (含在带宽闸门前排队到预算结束)
+    而没有测的 IP 不在其中，也不回调 on_result，调用方不应把它们记为失败
+    """
+    concurrency = concurrency or CONCURRENCY
+    geo_concurrency = geo_concurrency or GEO_CONCURRENCY
+    per_ip_timeout = per_ip_timeout or PER_IP_TIMEOUT
+    time_budget = time_budget or TIME_BUDGET
+    bandwidth_cap = BANDWIDTH_CAP if bandwidth_cap is None else bandwidth_cap
+
+    start = time.monotonic()
+    budget_end = start + time_budget
+    gate = BandwidthGate(bandwidth_cap, concurrency)
+    lock = threading.Lock()
+    results = []
+
+    def run_one(ip, port, geo_future):
+        # 在闸门前排队的时间只受全局预算限制，不占用单 IP 的测速时间
+        reserved = gate.acquire(budget_end, streams) if time.monotonic() < budget_end else None
+        if reserved is not None and time.monotonic() >= budget_end:
+            gate.release(reserved, 0)
+            reserved = None
+        if reserved is None:  # 预算用尽，未测
+            geo_future.cancel()
+            return
+        deadline = min(time.monotonic() + per_ip_timeout, budget_end)
+        measured = Measurement(int(port), 0.0, 0.0, 0)
+        try:
+            measured = speed_fn(ip, port, deadline)
+        except Exception as e:
+            count('speed.exception')
+            log(f" {ip} 测速异常: {e}")
+        finally:
+            gate.release(reserved, measured.single)
+        try:
+            label = geo_future.result()
+        except Exception as e:
+            count('geo.exception')
+            log(f" {ip} 归属地查询异常: {e}")
+            label = None
+        with lock:
+            port = str(measured.port)
+            results.append((ip, port, label, measured))
+            if on_result:
+                on_result(ip, port, label, measured)
+
+    # 归属地查询在独立线程池中提前全部提交，与带宽测试同时进行
+    with ThreadPoolExecutor(max_workers=geo_concurrency) as geo_pool, \
+            ThreadPoolExecutor(max_workers=concurrency) as speed_pool:
+        geo_futures = [geo_pool.submit(geo_fn, ip) for ip, _ in tasks]
+        futures = [speed_pool.submit(run_one, ip, port, gf) for (ip, port), gf in zip(tasks, geo_futures)]
+        for f in futures:
+            f.result()
+
+    skipped = len(tasks) - len(results)
+    if skipped:
+        print(f"全局时间预算 {time_budget:.0f}s 用尽，跳过 {skipped} 个 IP")
+    print(f"调度完成: 并发 {concurrency}, 用时 {time.monotonic() - start:.1f}s")
+    return results
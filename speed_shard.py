@@ -0,0 +1,117 @@
+"""分片测速：按 IP 的稳定哈希把候选分成 N 片，各片独立测速并写部分结果，最后合并成全局榜单
+
+    python test_speed.py --shard 2/4   # 只测第 2 片 (1..4)，结果写 speed_ip.shard-2-of-4.txt 等
+    python test_speed.py --merge 4     # 合并 4 片的部分结果，生成 speed_ip.txt / speed_ipv4.txt / speed_ipv6.txt
+    python test_speed.py --jobs 4      # 本机起 4 个进程各测一片 (均分带宽上限和并发数)，全部结束后自动合并
+
+多台 runner (如 Actions matrix) 各测一片时，把各片的部分结果文件收集到同一目录再 --merge。
+"""
+import os
+import sys
+import zlib
+import subprocess
+from speed_results import Rankings, read_records, write_atomic, format_record, OUTPUT_PATH, FAMILY_PATHS, TOP_N
+from run_report import RUN_REPORT_PATH, span, count
+from speed_scheduler import BANDWIDTH_CAP, CONCURRENCY, PREFILTER_CONCURRENCY
+from colo_trace import TRACE_CONCURRENCY
+
+SHARD_LOG_PATH = 'speed_test.log'  # --jobs 时各片子进程的输出，按 shard_path 加后缀
+
+
+def parse_shard(text):
+    """'i/N' -> (i, N)，1 <= i <= N"""
+    try:
+        i, n = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f'分片格式应为 i/N: {text}') from None
+    if not 1 <= i <= n:
+        raise ValueError(f'分片序号应在 1..{n}: {text}')
+    return i, n
+
+
+def shard_of(ip, n):
+    """ip 所属的分片 (1..n)；用 crc32 而不是 hash()，后者每个进程的随机种子不同"""
+    return zlib.crc32(ip.encode()) % n + 1
+
+
+def shard_tasks(tasks, shard):
+    """只保留属于 shard=(i, N) 的 (ip, port)"""
+    i, n = shard
+    return [task for task in tasks if shard_of(task[0], n) == i]
+
+
+def shard_path(path, shard):
+    """部分结果文件名: speed_ip.txt -> speed_ip.shard-2-of-4.txt；shard 为 None 时原样返回"""
+    if not shard:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard-{shard[0]}-of-{shard[1]}{ext}'
+
+
+def merge(n, granularities=(), top_n=TOP_N, path=OUTPUT_PATH, family_paths=FAMILY_PATHS):
+    """读 n 片的分地址族部分榜单，重新排出全局合并榜和各地址族榜 (写 path / family_paths)
+
+    每片的合并榜都是该片各地址族榜的子集，所以只读地址族榜就够了；
+    granularities: 其余标签粒度，各自的 speed_ip.<粒度>.txt 按部分文件里的标签重新渲染
+    """
+    with span('phase.merge'):
+        top = Rankings(top_n, path, family_paths)
+        missing = []
+        total = 0
+        for i in range(1, n + 1):
+            for family_path in family_paths.values():
+                part = shard_path(family_path, (i, n))
+                if not os.path.exists(part):
+                    missing.append(part)
+                    continue
+                for record in read_records(part):
+                    top.add(record)
+                    total += 1
+        top.flush()
+        root, ext = os.path.splitext(path)
+        for granularity in granularities:
+            locations = {}
+            for i in range(1, n + 1):
+                for record in read_records(shard_path(f'{root}.{granularity}{ext}', (i, n))):
+                    locations[record.ip] = record.location
+            write_atomic(f'{root}.{granularity}{ext}',
+                         [format_record(r._replace(location=locations.get(r.ip, r.location))) for r in top.records()])
+    count('merge.missing', len(missing))
+    print(f"合并 {n} 片部分结果: 读取 {total} 条，取前 {len(top.records())} 个写入 {path}"
+          f"{'，缺少 ' + ', '.join(missing) if missing else ''}")
+    return top
+
+
+def shard_env(jobs):
+    """--jobs 的子进程环境：同一台机器上各片共用网卡，带宽上限和并发数按片数均分，合计不超过单进程的设置"""
+    env = dict(os.environ)
+    if BANDWIDTH_CAP > 0:
+        env['SPEED_BANDWIDTH_CAP'] = str(BANDWIDTH_CAP / jobs)
+    for name, value in (('SPEED_CONCURRENCY', CONCURRENCY), ('SPEED_PREFILTER_CONCURRENCY', PREFILTER_CONCURRENCY),
+                        ('SPEED_TRACE_CONCURRENCY', TRACE_CONCURRENCY)):
+        env[name] = str(max(1, -(-value // jobs)))
+    return env
+
+
+def run_local(jobs, script=None):
+    """本机并行测 jobs 片：每片一个子进程 (--shard i/jobs)，输出写各自的日志，返回各片退出码
+
+    各片的带宽上限和并发数见 shard_env；多台机器各测一片时直接用 --shard，不做均分。
+    """
+    script = script or sys.argv[0]
+    procs = []
+    for i in range(1, jobs + 1):
+        shard = (i, jobs)
+        env = shard_env(jobs)
+        if RUN_REPORT_PATH:
+            env['RUN_REPORT_PATH'] = shard_path(RUN_REPORT_PATH, shard)
+        log = open(shard_path(SHARD_LOG_PATH, shard), 'w', encoding='utf-8')
+        procs.append((shard, log, subprocess.Popen([sys.executable, script, '--shard', f'{i}/{jobs}'],
+                                                   env=env, stdout=log, stderr=subprocess.STDOUT)))
+    print(f"已启动 {jobs} 个分片进程，日志见 {shard_path(SHARD_LOG_PATH, (1, jobs))} 等")
+    codes = []
+    for shard, log, proc in procs:
+        codes.append(proc.wait())
+        log.close()
+        print(f" 第 {shard[0]}/{shard[1]} 片结束，退出码 {codes[-1]}")
+    return codes
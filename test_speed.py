@@ -1,209 +1,222 @@
-import requests
 import time
 import re
 import os
-import subprocess
+import argparse
+import ipaddress
+from speed_scheduler import run_speed_tests, prefilter, TIME_BUDGET
+from geo_cache import default_cache
+from geo_resolver import resolve, prefetch_all, render_label, use_labels, LABELS, UNKNOWN
+from colo_trace import COLO_TRACE, discover, group
+from downloader import download, multi_download, ports_for, Measurement, PORT, MAX_TIME, STREAMS, RANK_BY
+from speed_results import Rankings, make_record, format_record, write_atomic, OUTPUT_PATH, FAMILY_PATHS
+from speed_shard import parse_shard, shard_tasks, shard_path, merge, run_local
+from run_report import span, count, log, finish
+from results_store import ResultsStore, INCREMENTAL, backoff_filter, incremental_split
 
-# CF 官方带宽测试端点 (10MB 随机数据)
-TEST_URL = 'https://speed.cloudflare.com/__down?bytes=10485760'  # 10MB
-HOST = 'speed.cloudflare.com'
-PORT = 443
+# CF 官方带宽测试下载量 (10MB 随机数据，端点见 downloader)
 FILE_SIZE = 10485760  # 字节，用于验证
 
 # 默认端口
 DEFAULT_PORT = 8443
 
-# 英文城市 → 中文映射（针对 fallback 英文名）
-EN_CITY_TO_CN = {
-    'San Francisco': '旧金山',
-    'New York': '纽约',
-    'Los Angeles': '洛杉矶',
-    'Chicago': '芝加哥',
-    'Houston': '休斯顿',
-    'Phoenix': '凤凰城',
-    'Philadelphia': '费城',
-    'San Antonio': '圣安东尼奥',
-    'San Diego': '圣迭戈',
-    'Dallas': '达拉斯',
-    'Seattle': '西雅图',
-    'Denver': '丹佛',
-    'Washington': '华盛顿',
-    'Boston': '波士顿',
-    'Detroit': '底特律',
-    'Nashville': '纳什维尔',
-    'Portland': '波特兰',
-    'Las Vegas': '拉斯维加斯',
-    'Memphis': '孟菲斯',
-    'Oklahoma City': '俄克拉荷马城',
-    'Baltimore': '巴尔的摩',
-    'Milwaukee': '密尔沃基',
-    'Albuquerque': '阿尔伯克基',
-    'Tucson': '图森',
-    'Fresno': '弗雷斯诺',
-    'Sacramento': '萨克拉门托',
-    'Long Beach': '长滩',
-    'Kansas City': '堪萨斯城',
-    'Mesa': '梅萨',
-    'Atlanta': '亚特兰大',
-    'Colorado Springs': '科罗拉多斯普林斯',
-    'Virginia Beach': '弗吉尼亚比奇',
-    'Raleigh': '罗利',
-    'Omaha': '奥马哈',
-    'Miami': '迈阿密',
-    'Oakland': '奥克兰',
-    'Minneapolis': '明尼阿波利斯',
-    'Tulsa': '塔尔萨',
-    'Cleveland': '克利夫兰',
-    'Wichita': '威奇托',
-    'Arlington': '阿灵顿',
-    # 加更多如果需要
-    'Unknown': '未知'
-}
+# 输出标签粒度 (geo_resolver.LABELS)，逗号分隔可同时输出多种：第一个写入 speed_ip.txt，
+# 其余各写一份 speed_ip.<粒度>.txt；归属地只查一次，各粒度都由同一条记录渲染
+SPEED_LABELS = os.environ.get('SPEED_LABELS', '')
 
-def translate_city(en_city):
-    """英文城市转中文"""
-    return EN_CITY_TO_CN.get(en_city, en_city)  # 未匹配返回原英文
+def test_speed(ip, port=PORT, retries=1, deadline=None, cutoff=None):
+    """测试 ip:port 的 CF 单流带宽 (MB/s)，重试失败；deadline 为 time.monotonic() 截止时间
 
-def get_chinese_city(ip):
-    """查询 IP 城市，并返回中文城市名（主: ip-api.com 单次；失败 fallback 备用1 (ipgeolocation.io) → 备用2 (ipinfo.io) 并翻译）"""
-    # 主 API: ip-api.com (HTTP, lang=zh-CN 获取中文，单次查询)
-    try:
-        response = requests.get(f'http://ip-api.com/json/{ip}?fields=status,city&lang=zh-CN', timeout=5)
-        data = response.json()
-        if data['status'] == 'success':
-            cn_city = data.get('city', '未知')
-            if cn_city != '未知':
-                print(f" 城市: {cn_city} (主 API)")
-                return cn_city
-            else:
-                print("  ip-api.com 返回未知，尝试备用1...")
-        else:
-            print(f"  ip-api.com status fail: {data.get('message', 'Unknown')}，尝试备用1...")
-    except Exception as e:
-        print(f"  ip-api.com 查询失败 {ip}: {e}，尝试备用1...")
-    
-    # 备用1: ipgeolocation.io (demo key, 英文后翻译)
-    try:
-        backup1_resp = requests.get(f'https://api.ipgeolocation.io/ipgeo?apiKey=demo&ip={ip}&fields=city', timeout=5)
-        if backup1_resp.status_code == 200:
-            backup1_data = backup1_resp.json()
-            en_city1 = backup1_data.get('city', '未知')
-            cn_city1 = translate_city(en_city1)
-            print(f"  备用1 成功: {en_city1} -> {cn_city1}")
-            return cn_city1
-        else:
-            print(f"  备用1 失败: {backup1_resp.status_code}，尝试备用2...")
-    except Exception as e:
-        print(f"  备用1 异常: {e}，尝试备用2...")
-    
-    # 备用2: ipinfo.io (英文后翻译)
-    try:
-        backup2_resp = requests.get(f'https://ipinfo.io/{ip}/json?lang=zh', timeout=5)
-        if backup2_resp.status_code == 200:
-            backup2_data = backup2_resp.json()
-            en_city2 = backup2_data.get('city', '未知')
-            cn_city2 = translate_city(en_city2)
-            print(f"  备用2 成功: {en_city2} -> {cn_city2}")
-            return cn_city2
-        else:
-            print(f"  备用2 失败: {backup2_resp.status_code}")
-        return '未知'
-    except Exception as e:
-        print(f"  备用2 异常: {e}")
-        return '未知'
-
-def test_speed(ip, retries=1):
-    """用 curl --resolve 测试 CF 带宽 (MB/s)，重试失败"""
+    下载走 downloader (默认进程内直连并自适应采样，速率收敛即停；SPEED_BACKEND=curl 切回 curl 子进程)
+    cutoff: 返回当前入榜最低速率的函数，预计达不到时提前结束
+    """
     for attempt in range(retries + 1):
-        cmd = [
-            'curl', '-s',
-            '--resolve', f'{HOST}:{PORT}:{ip}',
-            TEST_URL,
-            '-o', '/dev/null',
-            '-w', 'speed_download:%{speed_download}\nsize:%{size_download}\n',
-            '--max-time', '30',
-            '--connect-timeout', '10',
-            '--retry', '1',
-            '--insecure'
-        ]
-        try:
-            print(f" 测试 {ip}:443 (尝试 {attempt+1})...")
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=40)
-            if result.returncode == 0:
-                output = result.stdout.strip()
-                speed_bps = 0
-                downloaded = 0
-                for line in output.split('\n'):
-                    if line.startswith('speed_download:'):
-                        speed_bps = float(line.split(':')[1])
-                    elif line.startswith('size:'):
-                        downloaded = float(line.split(':')[1])
-                if downloaded >= FILE_SIZE * 0.9:
-                    speed_mbps = speed_bps / 1048576
-                    if speed_mbps > 0:
-                        print(f" 成功！下载 {downloaded/1048576:.1f}MB, 速度: {round(speed_mbps, 1)}MB/s")
-                        return round(speed_mbps, 1)
-                print(f" 下载不完整 (code {result.returncode}): {output}")
+        attempt_deadline = time.monotonic() + MAX_TIME
+        if deadline is not None:
+            attempt_deadline = min(attempt_deadline, deadline)
+            if attempt_deadline <= time.monotonic():
+                log(f" {ip} 已到截止时间，放弃")
                 return 0.0
-            else:
-                print(f" curl 失败 (code {result.returncode}): {result.stderr.strip() if result.stderr else 'Timeout'}")
-                if attempt < retries:
-                    time.sleep(2)
-                else:
-                    return 0.0
-        except subprocess.TimeoutExpired:
-            print(f" curl 超时 (30s)")
+        if attempt:
+            count('speed.retry')
+        log(f" 测试 {ip}:{port} (尝试 {attempt+1})...")
+        r = download(ip, FILE_SIZE, deadline=attempt_deadline, port=port, cutoff=cutoff)
+        if not r.error:
+            if r.stopped == 'below_cutoff':
+                log(f" 预计进不了榜，提前结束: {r.mbps:.1f}MB/s (下载 {r.bytes/1048576:.1f}MB)")
+                return round(r.mbps, 1)
+            if (r.stopped == 'converged' or r.bytes >= FILE_SIZE * 0.9) and r.mbps > 0:
+                log(f" 成功！下载 {r.bytes/1048576:.1f}MB, 速度: {round(r.mbps, 1)}±{r.variance ** 0.5:.1f}MB/s "
+                    f"(建连 {r.connect_time*1000:.0f}ms, 握手 {r.handshake_time*1000:.0f}ms, 首字节 {r.ttfb*1000:.0f}ms)")
+                return round(r.mbps, 1)
+            log(f" 下载不完整: {r.bytes} 字节")
             return 0.0
-        except Exception as e:
-            print(f" curl 异常: {e}")
+        log(f" 下载失败 ({r.error})，已收 {r.bytes} 字节")
+        if attempt < retries and (deadline is None or deadline - time.monotonic() > 2):
+            time.sleep(2)
+        else:
             return 0.0
     return 0.0
 
-def main():
+def measure(ip, port, deadline=None, cutoff=None):
+    """按 SPEED_PORTS 测一个或多个端口的单流带宽，取最快的端口；SPEED_STREAMS > 1 时再测该端口的多连接聚合带宽"""
+    if RANK_BY == 'aggregate':
+        cutoff = None  # 入榜线是聚合速率，不能拿来提前放弃单流测试
+    best = Measurement(int(port), 0.0, 0.0, 0)
+    for p in ports_for(port):
+        speed = test_speed(ip, p, deadline=deadline, cutoff=cutoff)
+        if speed > best.single:
+            best = Measurement(p, speed, 0.0, 0)
+    if STREAMS > 1 and best.single > 0:  # 调度器已按 STREAMS 条连接预占闸门带宽 (run_speed_tests streams=)
+        r = multi_download(ip, FILE_SIZE, STREAMS, deadline=min(time.monotonic() + MAX_TIME, deadline or float('inf')),
+                           port=best.port)
+        log(f" {STREAMS} 连接聚合: {r.mbps:.1f}MB/s (单流 {best.single}MB/s)" if not r.error
+            else f" {STREAMS} 连接测试失败 ({r.error})")
+        best = best._replace(aggregate=round(r.mbps, 1), streams=STREAMS)
+    return best
+
+def main(label='city', argv=None):
+    """label: 默认标签粒度 (geo_resolver.LABELS)，SPEED_LABELS 环境变量优先；分片参数见 speed_shard"""
+    parser = argparse.ArgumentParser(description='CF 带宽测速')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N', help='只测第 i 片 (共 N 片)，结果写部分文件')
+    parser.add_argument('--merge', type=int, metavar='N', help='只合并 N 片的部分结果')
+    parser.add_argument('--jobs', type=int, metavar='N', help='本机起 N 个进程分片测速，结束后合并')
+    args = parser.parse_args(argv)
     print("=== 脚本开始运行 ===")
+    labels = [g for g in (SPEED_LABELS or label).split(',') if g in LABELS] or [label]
+    use_labels(labels)
+    if args.merge or args.jobs:
+        if args.jobs:
+            with span('phase.shards'):
+                run_local(args.jobs)
+        merge(args.merge or args.jobs, labels[1:])
+        finish()
+        return
+    shard = args.shard
+    output_path = shard_path(OUTPUT_PATH, shard)
     try:
-        if not os.path.exists('ip.txt'):
-            print("ip.txt 不存在！")
-            return
-        with open('ip.txt', 'r', encoding='utf-8') as f:
-            lines = [line.strip() for line in f if line.strip() and not line.startswith('#') and not line.startswith('-')]
+        # 候选文件，逗号分隔可读多个 (如 ip.txt,ipv6.txt,candidates.txt，后者由 candidate_gen.py 生成)
+        input_paths = [path for path in os.environ.get('SPEED_INPUT', 'ip.txt,ipv6.txt').split(',') if path]
+        lines = []
+        for path in input_paths:
+            if not os.path.exists(path):
+                print(f"{path} 不存在！")
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                lines += [line.strip() for line in f if line.strip() and not line.startswith('#') and not line.startswith('-')]
+        lines = list(dict.fromkeys(lines))  # 多个文件间去重
         print(f"读取到 {len(lines)} 个 IP")
         if not lines:
-            print("ip.txt 中无有效 IP！")
+            print(f"{', '.join(input_paths)} 中无有效 IP！")
             return
-        results = []
-        failed_count = 0
+        tasks = []
         for line in lines:
-            # 提取 IP 和可选端口 (格式: IP:PORT#US 或 IP#US)
-            match = re.match(r'^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(?::(\d+))?\s*#(.*)$', line)
-            if not match:
+            # 提取 IP 和可选端口 (格式: IP:PORT#US、IP#US，IPv6 为 [IP]:PORT#US-IPV6 或 [IP]#US-IPV6)
+            match = re.match(r'^(?:\[([0-9A-Fa-f:.]+)\]|(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}))(?::(\d+))?\s*#(.*)$', line)
+            try:
+                ip = str(ipaddress.ip_address(match.group(1) or match.group(2)))  # IPv6 统一成压缩写法
+            except (AttributeError, ValueError):
                 print(f"跳过无效行: {line}")
                 continue
-            ip = match.group(1)
-            port = match.group(2) or str(DEFAULT_PORT)  # 优先自带端口，没有默认8443
-            ip_port = f"{ip}:{port}"
-            cn_city = get_chinese_city(ip)
-            print(f"\n测试 {ip_port} - {cn_city}")
-            speed = test_speed(ip)
-            time.sleep(1)  # 如前两天
+            port = match.group(3) or str(DEFAULT_PORT)  # 优先自带端口，没有默认8443
+            tasks.append((ip, port))
+        if shard:
+            # 按 IP 的稳定哈希分片，各片互不重叠，最后由 --merge 合并
+            tasks = shard_tasks(tasks, shard)
+            print(f"分片 {shard[0]}/{shard[1]}: 本片 {len(tasks)} 个 IP")
+        store = ResultsStore()  # 每次测量都追加进历史库 results.db
+        backed_off = 0
+        if INCREMENTAL:
+            # 增量模式: 连续失败的 IP 按指数退避跳过，连延迟探测都不做
+            tasks, backed_off = backoff_filter(store, tasks)
+        # 第一阶段: 并发测 TCP/TLS 延迟，只让延迟靠前的 IP 进入 10MB 带宽测试
+        with span('phase.prefilter'):
+            candidates = tasks
+            tasks, rtts = prefilter(tasks)
+            # 连不上的 IP 也记一次失败，连续失败的才会进入退避 (只是被 top-K 截掉的不算)
+            store.record_unreachable([task for task in candidates if task[0] not in rtts])
+        reused = []
+        if INCREMENTAL:
+            # 近期测过且延迟没明显变化的 IP 沿用历史得分，只对新 IP、过期 IP 和延迟变化的 IP 测带宽
+            tasks, reused = incremental_split(store, tasks, rtts)
+            print(f"增量模式: 测速 {len(tasks)} 个, 沿用历史结果 {len(reused)} 个, 退避跳过 {backed_off} 个")
+        # 先批量解析全部 IP 的归属地写入缓存，调度中的单 IP 查询直接命中
+        with span('phase.geo_prefetch'):
+            prefetch_all([ip for ip, _ in tasks] + [stats.ip for stats in reused])
+        # 请求 /cdn-cgi/trace 得到每个 IP 实际落到的数据中心，按 colo 分组：每组先测几个代表，
+        # 代表能进榜的 colo 再铺开测其余 IP，进不了榜的整组跳过
+        # 沿用历史结果的 IP 也探测 (trace 按 IP 缓存，重复探测基本都命中)，colo 标签才不会是未知
+        colos = {}
+        if COLO_TRACE:
+            with span('phase.colo_trace'):
+                colos = discover(tasks + [(stats.ip, stats.port) for stats in reused])
+        first, rest = group(tasks, colos)
+        colo_best = {}  # colo -> 代表中的最高速率
+        # IPv4/IPv6 共用调度器，各保留得分最高的 50 个 (speed_ipv4.txt / speed_ipv6.txt)，
+        # 合并榜取两者中最高的 50 个写入 speed_ip.txt；名单变化即原子写入
+        top = Rankings(50, output_path, {family: shard_path(path, shard) for family, path in FAMILY_PATHS.items()})
+        infos = {}  # ip -> GeoInfo，结束时按其余粒度重新渲染标签
+
+        def with_colo(ip, info):
+            if ip in colos:  # trace 到的 colo 比离线索引里的更准
+                info = (info or UNKNOWN)._replace(colo=colos[ip].colo)
+            return info
+
+        for stats in reused:  # 沿用的历史结果和本轮新测的结果一起排名
+            infos[stats.ip] = with_colo(stats.ip, resolve(stats.ip))
+            top.add(make_record(stats.ip, stats.port, render_label(infos[stats.ip], labels[0]), round(stats.score, 1), rtts[stats.ip]))
+        success_count = 0
+        failed_count = 0
+
+        def on_result(ip, port, info, measured):
+            nonlocal success_count, failed_count
+            info = infos[ip] = with_colo(ip, info)
+            location = render_label(info, labels[0])
+            speed = measured.speed
+            if ip in colos:
+                colo_best[colos[ip].colo] = max(colo_best.get(colos[ip].colo, 0.0), speed)
+            stats = store.record(ip, port, rtts[ip], speed, location, speed > 0)
             if speed > 0:
-                result = f"{ip_port}#{cn_city} {speed}MB/s"  # 格式: IP:端口#城市 速率
-                results.append(result)
-                print(f" -> 成功: {result}")
+                success_count += 1
+                # 按历史平滑得分 (速率 EWMA × (1 - 失败率)) 排名，而不是单次 10MB 测量
+                record = make_record(ip, port, location, round(stats.score, 1), rtts[ip], measured.aggregate, measured.streams)
+                top.add(record)
+                log(f" -> 成功: {format_record(record)} (本次 {speed}MB/s, p50 {stats.p50:.1f}, "
+                    f"p90 {stats.p90:.1f}, 失败率 {stats.fail_rate:.0%}, 样本 {stats.samples})")
             else:
                 failed_count += 1
-                print(f" -> 失败: 连接不通")
-        # 按速度降序排序，取前 50 个写入 speed_ip.txt
-        sorted_results = sorted(results, key=lambda x: float(re.search(r'(\d+\.?\d*)MB/s', x).group(1)), reverse=True)
-        top_50 = sorted_results[:50]  # 只取前 50
-        with open('speed_ip.txt', 'w', encoding='utf-8') as f:
-            for res in top_50:
-                f.write(res + '\n')
-        print(f"\n完成！共 {len(results)} 个成功 IP，按速度排序后取前 {len(top_50)} 个保存到 speed_ip.txt (失败 {failed_count} 个)")
+                log(f" -> 失败: {ip}:{port} 连接不通")
+
+        # 归属地查询与带宽测试并发进行 (并发数/截止时间/全局预算/总带宽见 speed_scheduler)
+        def speed_fn(ip, port, deadline):
+            return measure(ip, port, deadline=deadline, cutoff=lambda: top.cutoff(ip))
+
+        start = time.monotonic()
+        with span('phase.speed_tests'):
+            run_speed_tests(first, resolve, speed_fn, on_result=on_result, streams=STREAMS)
+        if rest:
+            fan_out = [colo for colo, group_tasks in rest.items()
+                       if colo_best.get(colo, 0.0) > 0 and colo_best[colo] >= top.cutoff(group_tasks[0][0])]
+            second = [task for colo in fan_out for task in rest[colo]]
+            remaining = TIME_BUDGET - (time.monotonic() - start)
+            print(f"按 colo 铺开: {len(fan_out)}/{len(rest)} 个数据中心 ({', '.join(fan_out) or '无'})，再测 {len(second)} 个 IP，"
+                  f"跳过 {sum(len(v) for v in rest.values()) - len(second)} 个")
+            count('colo.skipped', sum(len(v) for v in rest.values()) - len(second))
+            if second and remaining > 1:
+                with span('phase.speed_tests.fan_out'):
+                    run_speed_tests(second, resolve, speed_fn, on_result=on_result, time_budget=remaining,
+                                    streams=STREAMS)
+        top.flush()
+        for granularity in labels[1:]:
+            write_atomic(shard_path(f'speed_ip.{granularity}.txt', shard),
+                         [format_record(r._replace(location=render_label(infos.get(r.ip), granularity))) for r in top.records()])
+        store.close()
+        print(default_cache().stats())
+        print(f"\n完成！共 {success_count} 个成功 IP，按速度排序后取前 {len(top.records())} 个保存到 {output_path} (另有分地址族的榜单，失败 {failed_count} 个)")
     except Exception as e:
         print(f"脚本异常: {e}")
         import traceback
         traceback.print_exc()
+    finish()  # 写 run_report.json 并打印各阶段汇总
 
 if __name__ == '__main__':
     main()
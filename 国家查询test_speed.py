@@ -1,204 +1,9 @@
-import requests
-import time
-import re
-import os
-import subprocess
+"""与 test_speed.py 相同的测速流程，标签默认用中文国家名 (而非城市)
 
-# CF 官方带宽测试端点 (10MB 随机数据)
-TEST_URL = 'https://speed.cloudflare.com/__down?bytes=10485760'  # 10MB
-HOST = 'speed.cloudflare.com'
-PORT = 443
-FILE_SIZE = 10485760  # 字节，用于验证
-
-# 默认端口
-DEFAULT_PORT = 8443
-
-# 国家映射：支持 code (US) 和 full name (United States)
-EN_TO_CN = {
-    # Codes
-    'US': '美国',
-    'CA': '加拿大',
-    'CN': '中国',
-    'GB': '英国',
-    'DE': '德国',
-    'FR': '法国',
-    'JP': '日本',
-    'AU': '澳大利亚',
-    'IN': '印度',
-    'BR': '巴西',
-    'RU': '俄罗斯',
-    'KR': '韩国',
-    'NL': '荷兰',
-    'SG': '新加坡',
-    'HK': '香港',
-    'TW': '台湾',
-    # Full names (fallback)
-    'United States': '美国',
-    'Canada': '加拿大',
-    'China': '中国',
-    'United Kingdom': '英国',
-    'Germany': '德国',
-    'France': '法国',
-    'Japan': '日本',
-    'Australia': '澳大利亚',
-    'India': '印度',
-    'Brazil': '巴西',
-    'Russia': '俄罗斯',
-    'South Korea': '韩国',
-    'Netherlands': '荷兰',
-    'Singapore': '新加坡',
-    'Hong Kong': '香港',
-    'Taiwan': '台湾',
-    'Reserved': '预留',
-    'Global': '全球',
-    'Unknown': '未知'
-}
-
-def get_chinese_country(ip):
-    """查询 IP 国家，并返回中文名（主: ip-api.com；"未知"/失败时备用1: ipinfo.io → 备用2: ipgeolocation.io）"""
-    # 主 API: ip-api.com (HTTP 如前两天)
-    try:
-        response = requests.get(f'http://ip-api.com/json/{ip}?fields=status,country,countryCode', timeout=5)
-        data = response.json()
-        if data['status'] == 'success':
-            en_country = data.get('countryCode') or data.get('country', 'Unknown')  # 优先 code
-            if en_country != 'Unknown':
-                cn_country = EN_TO_CN.get(en_country, en_country)
-                print(f" 国家: {en_country} -> {cn_country}")
-                return cn_country
-            else:
-                print("  ip-api.com 返回 Unknown，尝试备用1: ipinfo.io...")
-        else:
-            print(f"  ip-api.com status fail: {data.get('message', 'Unknown')}，尝试备用1: ipinfo.io...")
-    except Exception as e:
-        print(f"  ip-api.com 查询失败 {ip}: {e}，尝试备用1: ipinfo.io...")
-    
-    # 备用1: ipinfo.io
-    try:
-        backup1_resp = requests.get(f'https://ipinfo.io/{ip}/country', timeout=5)
-        if backup1_resp.status_code == 200:
-            en_country1 = backup1_resp.text.strip()
-            if en_country1 and en_country1 != 'Unknown':
-                cn_country = EN_TO_CN.get(en_country1, en_country1)
-                print(f"  备用1 成功: {en_country1} -> {cn_country}")
-                return cn_country
-            else:
-                print("  ipinfo.io 返回 Unknown，尝试备用2: ipgeolocation.io...")
-        else:
-            print(f"  备用1 失败: {backup1_resp.status_code}，尝试备用2...")
-    except Exception as e:
-        print(f"  备用1 异常: {e}，尝试备用2...")
-    
-    # 备用2: ipgeolocation.io (demo key)
-    try:
-        backup2_resp = requests.get(f'https://api.ipgeolocation.io/ipgeo?apiKey=demo&ip={ip}&fields=country_code,country_name', timeout=5)
-        if backup2_resp.status_code == 200:
-            backup2_data = backup2_resp.json()
-            en_country2 = backup2_data.get('country_code') or backup2_data.get('country_name', 'Unknown')
-            if en_country2 != 'Unknown':
-                cn_country = EN_TO_CN.get(en_country2, en_country2)
-                print(f"  备用2 成功: {en_country2} -> {cn_country}")
-                return cn_country
-            print("  备用2 返回 Unknown")
-        else:
-            print(f"  备用2 失败: {backup2_resp.status_code}")
-        return '未知'
-    except Exception as e:
-        print(f"  备用2 异常: {e}")
-        return '未知'
-
-def test_speed(ip, retries=1):
-    """用 curl --resolve 测试 CF 带宽 (MB/s)，重试失败"""
-    for attempt in range(retries + 1):
-        cmd = [
-            'curl', '-s',
-            '--resolve', f'{HOST}:{PORT}:{ip}',
-            TEST_URL,
-            '-o', '/dev/null',
-            '-w', 'speed_download:%{speed_download}\nsize:%{size_download}\n',
-            '--max-time', '30',
-            '--connect-timeout', '10',
-            '--retry', '1',
-            '--insecure'
-        ]
-        try:
-            print(f" 测试 {ip}:443 (尝试 {attempt+1})...")
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=40)
-            if result.returncode == 0:
-                output = result.stdout.strip()
-                speed_bps = 0
-                downloaded = 0
-                for line in output.split('\n'):
-                    if line.startswith('speed_download:'):
-                        speed_bps = float(line.split(':')[1])
-                    elif line.startswith('size:'):
-                        downloaded = float(line.split(':')[1])
-                if downloaded >= FILE_SIZE * 0.9:
-                    speed_mbps = speed_bps / 1048576
-                    if speed_mbps > 0:
-                        print(f" 成功！下载 {downloaded/1048576:.1f}MB, 速度: {round(speed_mbps, 1)}MB/s")
-                        return round(speed_mbps, 1)
-                print(f" 下载不完整 (code {result.returncode}): {output}")
-                return 0.0
-            else:
-                print(f" curl 失败 (code {result.returncode}): {result.stderr.strip() if result.stderr else 'Timeout'}")
-                if attempt < retries:
-                    time.sleep(2)
-                else:
-                    return 0.0
-        except subprocess.TimeoutExpired:
-            print(f" curl 超时 (30s)")
-            return 0.0
-        except Exception as e:
-            print(f" curl 异常: {e}")
-            return 0.0
-    return 0.0
-
-def main():
-    print("=== 脚本开始运行 ===")
-    try:
-        if not os.path.exists('ip.txt'):
-            print("ip.txt 不存在！")
-            return
-        with open('ip.txt', 'r', encoding='utf-8') as f:
-            lines = [line.strip() for line in f if line.strip() and not line.startswith('#') and not line.startswith('-')]
-        print(f"读取到 {len(lines)} 个 IP")
-        if not lines:
-            print("ip.txt 中无有效 IP！")
-            return
-        results = []
-        failed_count = 0
-        for line in lines:
-            # 提取 IP 和可选端口 (格式: IP:PORT#US 或 IP#US)
-            match = re.match(r'^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(?::(\d+))?\s*#(.*)$', line)
-            if not match:
-                print(f"跳过无效行: {line}")
-                continue
-            ip = match.group(1)
-            port = match.group(2) or str(DEFAULT_PORT)  # 优先自带端口，没有默认8443
-            ip_port = f"{ip}:{port}"
-            cn_country = get_chinese_country(ip)
-            print(f"\n测试 {ip_port} - {cn_country}")
-            speed = test_speed(ip)
-            time.sleep(1)  # 如前两天
-            if speed > 0:
-                result = f"{ip_port}#{cn_country} {speed}MB/s"  # 格式: IP:端口#国家 速率
-                results.append(result)
-                print(f" -> 成功: {result}")
-            else:
-                failed_count += 1
-                print(f" -> 失败: 连接不通")
-        # 按速度降序排序，取前 50 个写入 speed_ip.txt
-        sorted_results = sorted(results, key=lambda x: float(re.search(r'(\d+\.?\d*)MB/s', x).group(1)), reverse=True)
-        top_50 = sorted_results[:50]  # 只取前 50
-        with open('speed_ip.txt', 'w', encoding='utf-8') as f:
-            for res in top_50:
-                f.write(res + '\n')
-        print(f"\n完成！共 {len(results)} 个成功 IP，按速度排序后取前 {len(top_50)} 个保存到 speed_ip.txt (失败 {failed_count} 个)")
-    except Exception as e:
-        print(f"脚本异常: {e}")
-        import traceback
-        traceback.print_exc()
+归属地由 geo_resolver 统一解析，两种标签来自同一条记录；需要同时输出多种标签时
+直接 SPEED_LABELS=country,city python test_speed.py，不必再跑一遍测速。
+"""
+from test_speed import main
 
 if __name__ == '__main__':
-    main()
+    main(label='country')